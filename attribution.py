@@ -24,6 +24,23 @@ This module implements attribution ("Blah," he said",
 "Why?", she asked")
 """
 
+# the patterns we match
+_re_quote_said_quote = \
+    "QuoteBlk AgentSaid Comma|Terminator agentSaid QuoteBlk"
+_re_quote_said_quote2 = "QuoteBlk AgentSaid Comma|Terminator QuoteBlk"
+_re_said_quote = "AgentSaid Comma QuoteBlk"
+_re_quote_said = "QuoteBlk Comma? AgentSaid"
+
+def compile_res():
+    """
+    Compile our patterns (normally they're compiled on first use).
+    The parser's startup cache calls this, so it can save them.
+    """
+    for _re in (_re_quote_said_quote,_re_quote_said_quote2,
+        _re_said_quote,_re_quote_said):
+        if _re not in pnRE.redct:
+            pnRE.redct[_re] = pnRE.compile_re(_re)
+
 # helper for "setAttributions"
 def set_attribution(quote,attr):
     # re tree structure: two quotes can share the same attribution.
@@ -50,8 +67,7 @@ def set_attributions(nds):
     _nds = []
     i = 0
     while i < len(nds):
-        if pnRE.match(nds,
-            "QuoteBlk AgentSaid Comma|Terminator agentSaid QuoteBlk",i):
+        if pnRE.match(nds,_re_quote_said_quote,i):
             q1 = pnRE.mr(0) 
             set_attribution(q1,pnRE.mr(1))
             q2 = nds[i+4]
@@ -60,8 +76,7 @@ def set_attributions(nds):
             _nds.append(q2)
             i += 5
             continue
-        if pnRE.match(nds,
-            "QuoteBlk AgentSaid Comma|Terminator QuoteBlk",i):
+        if pnRE.match(nds,_re_quote_said_quote2,i):
             q1 = pnRE.mr(0)
             set_attribution(q1,pnRE.mr(1))
             q2 = pnRE.mr(3)
@@ -70,15 +85,13 @@ def set_attributions(nds):
             _nds.append(q2)
             i += 4
             continue
-        if pnRE.match(nds,
-            "AgentSaid Comma QuoteBlk",i):
+        if pnRE.match(nds,_re_said_quote,i):
             q = pnRE.mr(2)
             set_attribution(q,pnRE.mr(0))
             _nds.append(q)
             i += 3
             continue
-        if pnRE.match(nds,
-            "QuoteBlk Comma? AgentSaid",i):
+        if pnRE.match(nds,_re_quote_said,i):
             q = pnRE.mr(0)
             set_attribution(q,pnRE.mr(2))
             _nds.append(q)
@@ -13,11 +13,15 @@
 # limitations under the License.
 
 import re
+import bisect
+import array
 from defs import *
 from nd import Nd
 import vcb
 
 import os
+import sys
+import time
 import serializer
 
 
@@ -29,10 +33,33 @@ dictionary)
 """
 # the source we're going to lex
 src = None
-# mapping, source index-> line number
-lno_map = None
-# mapping, source index-> column number
-col_map = None
+# line number for the start of the source, and column for its first
+# character
+src_lno = 1
+src_col = 1
+# offsets of the newlines in the source, ascending. See "get_loc".
+nl_offsets = None
+# Tokens and source offsets are held in int arrays ("new_buf"), not
+# lists: an array holds its elements as raw machine ints. The lexer
+# creates the arrays for a source, and the parse blocks are views
+# (index ranges) into them.
+def new_buf():
+    """ create an int array, for tokens or source offsets """
+    return array.array('i')
+
+def get_loc(ix):
+    """
+    get the location of source index "ix": returns (line,column).
+    Columns start at 1.
+    """
+    if ix < 0:
+        ix += len(src)
+    # number of newlines before "ix"
+    n = bisect.bisect_left(nl_offsets,ix)
+    if n == 0:
+        return (src_lno,ix+src_col)
+    return (src_lno+n,ix-nl_offsets[n-1])
+
 # lexing functions
 
 def is_wrd_char(i,E,src):
@@ -90,26 +117,52 @@ def lex_wrd(i,E,src):
     while is_wrd_char(i+1,E,src):
         i += 1
     # is this "Mr."? May need to bind a trailing period.
-    if i+1<=E and src[i+1]=='.':
-        sp = src[S:i+1]
-        tok = vcb.lkup(sp.lower(),False)
-        if vcb.check_prop(tok,WP_abbrev):
-            i += 1
+    if i+1<=E and src[i+1]=='.' and is_abbrev(src[S:i+1]):
+        i += 1
     return i
 
+def is_abbrev(sp):
+    """
+    is word "sp" an abbreviation ("Mr")? If so, it binds a trailing
+    period. Results are cached (see "vcb.ExpansionCache").
+    """
+    key = '.' + sp
+    bind = vcb.expansions.get(key)
+    if bind is None:
+        sp_lc = sp.lower()
+        tok = vcb.lkup(sp_lc,False)
+        bind = vcb.check_prop(tok,WP_abbrev)
+        vcb.expansions.put(key,bind,(tok,),sp_lc if tok == 0 else None)
+    return bind
+
 def append_contract(S,sp,toks,tok_loc):
-    """ append token(s) for word "sp", expanding contractions as needed """
+    """
+    append token(s) for word "sp", expanding contractions as needed.
+    Expansions are cached (see "vcb.ExpansionCache").
+    """
+    terms = vcb.expansions.get(sp)
+    if terms is None:
+        sp_lc = sp.lower()
+        key = vcb.lkup(sp_lc,False)
+        terms = expand_contract(sp,key)
+        # the expansion depends on "sp_lc" being undefined, if it is
+        vcb.expansions.put(sp,terms,(key,)+terms,
+            sp_lc if key == 0 else None)
+    toks.extend(terms)
+    tok_loc.extend([S]*len(terms))
+
+def expand_contract(sp,key):
+    """
+    get the token(s) for word "sp", expanding contractions as needed:
+    returns a tuple. "key" is the entry for the lower case version of
+    "sp" (0 if there's none).
+    """
     # is there a rewrite rule for this word?
-    key = vcb.lkup(sp.lower(),False)
     if key != 0 :
-        test = [key]
-        rule = vcb.find_rewrite(test,0)
+        rule = vcb.find_rewrite([key],0)
         if rule != None:
-            rhs = vcb.get_rhs_rewrite(rule,sp[0].isupper())
-            for e in rhs:
-                toks.append(e)
-                tok_loc.append(S)
-        return
+            return tuple(vcb.get_rhs_rewrite(rule,sp[0].isupper()))
+        return ()
     # split on ticks
     terms = sp.split("'")
     if len(terms) == 2:
@@ -122,83 +175,71 @@ def append_contract(S,sp,toks,tok_loc):
         l0 = len(t0)
         if l0 > 2 and t0lc.endswith('n') and t1lc == 't' :
             # "wouldn't"
-            toks.append(vcb.get_vocab(t0[0:l0-1]))
-            toks.append(vcb.get_vocab("not"))
-            tok_loc.extend((S,S))
-            return
+            return (vcb.get_vocab(t0[0:l0-1]),vcb.get_vocab("not"))
         if l0 >= 1 and t1lc == 're' :
             # "we're"
-            toks.append(vcb.get_vocab(t0))
-            toks.append(vcb.get_vocab("are"))
-            tok_loc.extend((S,S))
-            return
+            return (vcb.get_vocab(t0),vcb.get_vocab("are"))
         if l0 >= 1 and t1lc == 'll' :
             # "we'll"
-            toks.append(vcb.get_vocab(t0))
-            toks.append(vcb.get_vocab("will"))
-            tok_loc.extend((S,S))
-            return
+            return (vcb.get_vocab(t0),vcb.get_vocab("will"))
         if l0 >= 1 and t1lc == 've' :
             # "we've"
-            toks.append(vcb.get_vocab(t0))
-            toks.append(vcb.get_vocab("have"))
-            tok_loc.extend((S,S))
-            return
+            return (vcb.get_vocab(t0),vcb.get_vocab("have"))
         # "'s" and "'d" are context dependant and are resolved during
         # the parse
         if t1lc == 's' or t1lc == 'd' :
-            toks.append(vcb.get_vocab(t0))
-            toks.append(vcb.get_vocab("'" + t1))
-            tok_loc.extend((S,S))
-            return
+            return (vcb.get_vocab(t0),vcb.get_vocab("'" + t1))
     # default is to accept construct as a single word
-    toks.append(vcb.get_vocab(sp))
-    tok_loc.append(S)
-
-def apply_rewrite_rules(toks,tok_loc):
-    """ rewrite token sequence, applying rewrite rules """
-    _toks = toks
-    _tok_loc = tok_loc
-    toks = []
-    tok_loc = []
-    i = 0
-    while i<len(_toks):
-        rix = vcb.find_rewrite(_toks,i)
-        if rix != None:
-            # For token-location, we have to approximate. All terms in
-            # the rewrite are assigned location of first term of lhs,
-            # except for last term in the rewrite; that gets location
-            # of last term in lhs.
-            n_lhs = len(vcb.rwrules.lhs[rix])
-            SfirstTerm = _tok_loc[i]
-            SlastTerm = _tok_loc[i+n_lhs-1]
-            want_upper = vcb.spell(_toks[i]).isupper()
-            terms = vcb.get_rhs_rewrite(rix,want_upper)
-            for j in range(0,len(terms)):
-                S = SlastTerm if j == len(terms) -1 else SfirstTerm
-                toks.append(terms[j])
-                tok_loc.append(S)
-            i += n_lhs
-        else:
-            toks.append(_toks[i])
-            tok_loc.append(_tok_loc[i])
-            i += 1
-    return (toks,tok_loc)
+    return (vcb.get_vocab(sp),)
+
+# Token shapes, for proper name detection. The rewrite pass computes
+# the flags for each token once (see "append_shapes"), and the name
+# rewrite works from them.
+SH_CAP = 0x1      # capitalized: upper case, then lower case ("John")
+SH_CAPS = 0x2     # all caps ("NASA", "F")
+SH_SINGLE = 0x4   # a single character
+SH_ALPHA = 0x8    # all letters
+SH_PUNCT = 0x10   # a single character that isn't a letter or digit
+SH_START = 0x20   # starts a sentence: first token, or follows a
+                  # token that isn't all letters
+
+def get_shape(sp):
+    """ get the shape flags for spelling "sp" (all but SH_START) """
+    sh = 0
+    if len(sp) > 1:
+        if sp[0].isupper() and sp[1].islower():
+            sh |= SH_CAP
+    elif len(sp) == 1:
+        sh |= SH_SINGLE
+        if not sp.isalnum():
+            sh |= SH_PUNCT
+    if sp.isupper():
+        sh |= SH_CAPS
+    if sp.isalpha():
+        sh |= SH_ALPHA
+    return sh
 
-def canbe_proper_name(i,toks):
+def append_shapes(toks,shapes,shape_of):
+    """
+    append shape flags to "shapes" for the elements of "toks" that
+    don't have them yet. "shape_of" caches token->shape.
+    """
+    for i in xrange(len(shapes),len(toks)):
+        tok = toks[i]
+        sh = shape_of.get(tok)
+        if sh is None:
+            sh = shape_of[tok] = get_shape(vcb.spell(tok))
+        if i == 0 or (shapes[i-1] & SH_ALPHA) == 0:
+            sh |= SH_START
+        shapes.append(sh)
+
+def canbe_proper_name(i,toks,shapes):
     if i>=len(toks):
         return False
-    sp = vcb.spell(toks[i])
-    if len(sp)>1 and sp[0].isupper() and sp[1].islower():
+    sh = shapes[i]
+    if sh & SH_CAP:
         # Camel case. Are we at the start of a sentence?
-        at_start = False
-        if i == 0:
-            at_start = True
-        else:
-            sp_prv = vcb.spell(toks[i-1])
-            if not sp_prv.isalpha():
-                at_start = True
-        if at_start:
+        if sh & SH_START:
             # If this word is known to our vocabulary, we in
             # general reject it; exception is for words marked as names.
             props = vcb.get_props(toks[i])
@@ -209,59 +250,195 @@ def canbe_proper_name(i,toks):
         return True
     return False
 
-def canbe_mi(i,toks):
+def canbe_mi(i,toks,shapes,period):
+    """ is toks[i] a middle initial ("F", followed by "period")? """
     if i+1>=len(toks):
         return False
-    sp = vcb.spell(toks[i])
-    spnxt = vcb.spell(toks[i+1])
-    return len(sp)==1 and sp[0].isupper() and spnxt=='.'
-
-def rewrite_proper_names(toks,tok_loc):
-    """ rewrite token sequence, so "John F.Kennedy" becomes a single token """
-    _toks = toks
-    _tok_loc = tok_loc
-    toks = []
-    tok_loc = []
-    i = 0
-    while i<len(_toks):
-        if canbe_proper_name(i,_toks):
-            S = i
+    return (shapes[i] & (SH_SINGLE|SH_CAPS)) == (SH_SINGLE|SH_CAPS) \
+        and toks[i+1] == period
+
+def rewrite_proper_names(toks,tok_loc,shapes,i,out_toks,out_loc,names,
+        final):
+    """
+    Proper name rewrite, so "John F.Kennedy" becomes a single token.
+    We consume "toks" (with shape flags "shapes") from element "i",
+    appending to "out_toks" and "out_loc", and return the index of the
+    first element not yet consumed. Unless "final" is True, "toks" may
+    not be complete: we then stop where we'd have to see elements we
+    don't have yet. Names are appended as placeholders: "names" gets
+    an entry (ix,spelling) for each, and the caller defines their
+    tokens.
+    """
+    spell = vcb.spell
+    period = vcb.dct.lkup('.',False)
+    n = len(toks)
+    while i<n:
+        # most tokens aren't capitalized: test that inline
+        if (shapes[i] & SH_CAP) and canbe_proper_name(i,toks,shapes):
             E = i
-            sp_seq = [vcb.spell(_toks[S])]
+            sp_seq = [spell(toks[i])]
             while True:
-                if canbe_proper_name(E+1,_toks):
-                    sp_seq.append(vcb.spell(_toks[E+1]))
+                if not final and E+1 >= n:
+                    return i
+                if canbe_proper_name(E+1,toks,shapes):
+                    sp_seq.append(spell(toks[E+1]))
                     E += 1
                     continue
-                if canbe_mi(E+1,_toks):
-                    sp_seq.append(vcb.spell(_toks[E+1])+'.')
+                if not final and E+2 >= n:
+                    return i
+                if canbe_mi(E+1,toks,shapes,period):
+                    sp_seq.append(spell(toks[E+1])+'.')
                     E += 2
                     continue
                 break
-            if E > S:
-                sp_all = ' '.join(sp_seq)
-                toks.append(vcb.get_vocab(sp_all))
-                tok_loc.append(_tok_loc[i])
+            if E > i:
+                names.append((len(out_toks),' '.join(sp_seq)))
+                out_toks.append(0)
+                out_loc.append(tok_loc[i])
                 i = E + 1
                 continue
-        toks.append(_toks[i])
-        tok_loc.append(_tok_loc[i])
+        out_toks.append(toks[i])
+        out_loc.append(tok_loc[i])
         i += 1
+    return i
+
+def rewrite(toks,tok_loc):
+    """
+    rewrite token sequence: apply the rewrite rules, and collapse
+    proper names into single tokens. This is one pass over "toks":
+    the proper name rewrite follows a few tokens behind the rule
+    rewrite, reading its output.
+    """
+    # output of the rule rewrite, and the shape flags for its tokens
+    rw_toks = new_buf()
+    rw_loc = new_buf()
+    rw_shapes = new_buf()
+    shape_of = {}
+    # final output
+    out_toks = new_buf()
+    out_loc = new_buf()
+    names = []
+    i_names = 0
+    if vcb.rwrules.trie is None:
+        vcb.rwrules.compile()
+    # words that start a rule's lhs
+    starts = vcb.rwrules.trie[0]
+    get_def = vcb.get_def
+    n = len(toks)
+    i = 0
+    while i<n:
+        rix = None
+        if get_def(toks[i]) in starts:
+            rix = vcb.find_rewrite(toks,i)
+        if rix != None:
+            # For token-location, we have to approximate. All terms in
+            # the rewrite are assigned location of first term of lhs,
+            # except for last term in the rewrite; that gets location
+            # of last term in lhs.
+            n_lhs = len(vcb.rwrules.lhs[rix])
+            SfirstTerm = tok_loc[i]
+            SlastTerm = tok_loc[i+n_lhs-1]
+            want_upper = vcb.spell(toks[i]).isupper()
+            terms = vcb.get_rhs_rewrite(rix,want_upper)
+            for j in range(0,len(terms)):
+                S = SlastTerm if j == len(terms) -1 else SfirstTerm
+                rw_toks.append(terms[j])
+                rw_loc.append(S)
+            i += n_lhs
+        else:
+            rw_toks.append(toks[i])
+            rw_loc.append(tok_loc[i])
+            i += 1
+        if len(rw_toks) - i_names > 32:
+            append_shapes(rw_toks,rw_shapes,shape_of)
+            i_names = rewrite_proper_names(rw_toks,rw_loc,rw_shapes,
+                i_names,out_toks,out_loc,names,False)
+    append_shapes(rw_toks,rw_shapes,shape_of)
+    rewrite_proper_names(rw_toks,rw_loc,rw_shapes,i_names,
+        out_toks,out_loc,names,True)
+    # Names get their entries once the rule rewrite is done, so
+    # overlay entries are created in the same order as a rewrite
+    # of the whole sequence, followed by a name pass.
+    for ix,sp in names:
+        out_toks[ix] = vcb.get_vocab(sp)
+    return (out_toks,out_loc)
+
+# The scanner. There are two implementations: "scan_re" matches each
+# token with a single compiled regular expression, "scan" walks the
+# source a character at a time. They give the same result; "scan_re"
+# is faster. It handles str sources (for unicode, "isalnum" and
+# friends don't agree with the regular expression's character
+# classes, so we use "scan").
+use_re_scanner = True
+
+# regular expression for "scan_re". "_wrd" is a word char (see
+# "is_wrd_char"); a hyphen is a word char if it has letters/digits on
+# both sides. "_dot_letter" is a period followed by a single
+# letter/digit (see "is_dot_letter_seq": note this accepts ".S" in
+# "U.SA", as the letter is followed by the last char of the source).
+_wrd = r"(?:[A-Za-z0-9_']|(?<=[A-Za-z0-9])-(?=[A-Za-z0-9]))"
+_dot_letter = r"(?:\.[A-Za-z0-9](?=[^A-Za-z0-9]|[A-Za-z0-9]\Z))"
+_re_tok = re.compile(r"""
+    # white space before the token
+    [ \t\r\n]*
+    # multiple dashes lex as a single token
+    (?:(?P<dash>-+)
+    # "$" binds to the word that follows. Numbers: "1,200.00"
+    |(?P<num>\$?[0-9](?:[0-9]|[.,][0-9])*%(wrd)s*)
+    # abbreviations like "B.C.", "U.S.A"
+    |(?P<abbr>\$?[A-Za-z_']%(dot_letter)s+\.?)
+    |(?P<wrd>\$?[A-Za-z_']%(wrd)s*)
+    # everything else lexes as a single token
+    |(?P<char>[^ \t\r\n]))
+    """ % {'wrd':_wrd, 'dot_letter':_dot_letter}, re.VERBOSE)
+
+def scan_re():
+    """
+    tokenize the source (no rewrites): returns (toks,tok_loc). This
+    gives the same result as "scan".
+    """
+    toks = new_buf()
+    tok_loc = new_buf()
+    _get_vocab = vcb.get_vocab
+    N = len(src)
+    # set if a word binds the period that follows it
+    skip_period = False
+    for m in _re_tok.finditer(src):
+        if skip_period:
+            # this match is the period
+            skip_period = False
+            continue
+        kind = m.lastgroup
+        S = m.start(kind)
+        i = m.end()
+        if kind == 'dash' or kind == 'char':
+            toks.append(_get_vocab(src[S:i]))
+            tok_loc.append(S)
+            continue
+        # location of a "$word" is the location of the word
+        ixS = S+1 if src[S] == '$' else S
+        if kind == 'wrd' and i < N and src[i] == '.':
+            # is this "Mr."? May need to bind a trailing period.
+            if is_abbrev(src[ixS:i]):
+                i += 1
+                skip_period = True
+        sp = src[S:i]
+        if sp.count("'") == 0:
+            toks.append(_get_vocab(sp))
+            tok_loc.append(ixS)
+        else:
+            append_contract(ixS,sp,toks,tok_loc)
     return (toks,tok_loc)
 
-def lex():
+def scan():
     """
-    tokenize source text. Returns
-    (toks,tokLoc). "toks" is a list of tokens (indices into the
-    vocabulary's dictionary. "tokLoc[i]" gives the index in the source
-    text for the first character of the i_th token.
+    tokenize the source (no rewrites), walking it a character at a
+    time: returns (toks,tok_loc).
     """
     # "E": max value, index into src
     E = len(src)-1
-    if src is None:
-        return ([],[])
-    toks = []
-    tok_loc = []
+    toks = new_buf()
+    tok_loc = new_buf()
     _get_vocab = vcb.get_vocab
     i = 0
     while i <= E:
@@ -299,47 +476,97 @@ def lex():
         toks.append(_get_vocab(src[i]))
         tok_loc.append(S)
         i += 1
-    # rewrite as per the rules defined in "vcb.txt"
-    toks,tok_loc = apply_rewrite_rules(toks,tok_loc)
-    # collapse "John F. Kennedy" into a single token
-    return rewrite_proper_names(toks,tok_loc)
-
-def is_opener(tok):
-    """ does 'tok' open a nested block? """
-    sp = vcb.spell(tok)
-    return sp=='(' or sp=='{' or sp=='[' or sp=='\'' or sp=='"'
-
-def find_closer(toks,i):
-    """ find closer for nested block """
-    sp_opener = vcb.spell(toks[i])
-    # this initialization corrct for single and double quotes
-    closer = toks[i]
-    if sp_opener == '{':
-        closer = vcb.lkup('}',True)
-    elif sp_opener == '[':
-        closer = vcb.lkup(']',True)
-    elif sp_opener == '(':
-        closer = vcb.lkup(')',True)
-    i += 1
-    while i<len(toks):
-        if toks[i]==closer:
-            return i
-        if is_opener(toks[i]):
-            E = find_closer(toks,i)
-            if E == -1:
-                i += 1
-            else:
-                i = E + 1
+    return (toks,tok_loc)
+
+def lex():
+    """
+    tokenize source text. Returns
+    (toks,tokLoc). "toks" is an array of tokens (indices into the
+    vocabulary's dictionary. "tokLoc[i]" gives the index in the source
+    text for the first character of the i_th token.
+    """
+    if src is None:
+        return (new_buf(),new_buf())
+    if use_re_scanner and isinstance(src,str):
+        toks,tok_loc = scan_re()
+    else:
+        toks,tok_loc = scan()
+    # rewrite as per the rules defined in "vcb.txt", and collapse
+    # "John F. Kennedy" into a single token
+    return rewrite(toks,tok_loc)
+
+# openers for nested blocks, and their closers
+brackets = (('(',')'),('{','}'),('[',']'),('\'','\''),('"','"'))
+
+def get_closer_table(toks):
+    """
+    Get the table opener->closer, for the openers in "toks" (the
+    table maps token to token).
+    """
+    openers = {}
+    for sp_opener,sp_closer in brackets:
+        tok = vcb.dct.lkup(sp_opener,False)
+        if tok != 0:
+            openers[tok] = sp_closer
+    closer_of = {}
+    if len(openers) == 0:
+        return closer_of
+    # A closer is created as needed: this is done in order of first
+    # appearance of the openers.
+    for tok in toks:
+        if tok in openers and tok not in closer_of:
+            closer_of[tok] = vcb.lkup(openers[tok],True)
+    return closer_of
+
+def get_closers(toks,closer_of):
+    """
+    Find the closers for the openers in "toks". Returns a list:
+    element "i" is the index of the closer for the opener at "i", or
+    -1 if it has none.
+
+    This is a single pass, left to right, with a stack of the openers
+    still open. A token that matches the closer of an open opener
+    closes the innermost such opener, even if it could open a block
+    (quotes); openers opened after that one are left without a
+    closer. So a stray opener doesn't stop an enclosing block from
+    closing, a stray closer is ignored, and the blocks found are
+    properly nested: the table serves the nested blocks as well.
+    """
+    closers = [-1]*len(toks)
+    stack = []
+    # n_open[c]: the number of openers on the stack closed by "c"
+    n_open = {}
+    for c in closer_of.itervalues():
+        n_open[c] = 0
+    for i in xrange(len(toks)):
+        tok = toks[i]
+        if n_open.get(tok,0) > 0:
+            while True:
+                j = stack.pop()
+                c = closer_of[toks[j]]
+                n_open[c] -= 1
+                if c == tok:
+                    break
+            closers[j] = i
             continue
-        i += 1
-    return -1
+        c = closer_of.get(tok)
+        if c is not None:
+            stack.append(i)
+            n_open[c] += 1
+    return closers
 
 class ParseBlk(Nd):
     """ Parse block """
-    def __init__(self,toks,tok_loc):
+    def __init__(self,toks,tok_loc,tok_S=0,tok_E=None):
         Nd.__init__(self,-1,-1)
+        # The block's tokens are toks[tok_S..tok_E]: the token arrays
+        # are shared by the blocks for a source.
         self.toks = toks
         self.tok_loc = tok_loc
+        self.tok_S = tok_S
+        if tok_E is None and toks is not None:
+            tok_E = len(toks)-1
+        self.tok_E = tok_E
         # parenthesized text and quotes are represented as containers
         # "bracket" is the bracket character -- quote, left paren, etc.
         self.sublst = None
@@ -355,9 +582,9 @@ def print_blk_toks(lst,indent=0):
             print_blklst(b.sublst,indent+1)
         else:
             print '%sParseBlk. toks:' % mar
-            for i in range(0,len(b.toks)):
+            for i in range(b.tok_S,b.tok_E+1):
                S = b.tok_loc[i]
-               print '%slno: %d col:%d' % (mar,lno_map[S],col_map[S])
+               print '%slno: %d col:%d' % ((mar,) + get_loc(S))
                print '%s%s\n' % (mar,vcb.spell(b.toks[i]))
                
 def print_blklst(lst,indent=0):
@@ -370,88 +597,349 @@ def print_blklst(lst,indent=0):
             print_blklst(b.sublst,indent+1)
         else:
             print '%sParseBlk:' % mar
-            print '%s%s' % (mar,vcb.spell(b.toks))
+            print '%s%s' % (mar,vcb.spell(b.toks[b.tok_S:b.tok_E+1].tolist()))
     
 def _get_parse_blks(toks,tok_loc):
     """
-    Recursively break a token sequence into a sequence of blocks for
-    parsing.
+    Break a token sequence into a sequence of blocks for parsing.
+    Quotes and parenthesized text become container blocks, whose
+    content is broken into blocks in turn. We use a stack (rather
+    than recursion) for the nesting. Note the span (S,E) of a block
+    gives token indices relative to the start of the content that
+    contains it.
     """
+    closer_of = get_closer_table(toks)
+    # computed if we meet an opener
+    closers = None
     lst = []
-    i = 0
-    while i < len(toks):
-        if is_opener(toks[i]):
-            E = find_closer(toks,i)
-            if E == -1:
+    # Stack entries are [lst,S,E,i,blk,parent_lst]: "lst" is the list
+    # of blocks for toks[S..E-1], and "i" is the next token to
+    # consider. For the content of a container, "blk" is the
+    # container, and "parent_lst" is the list we add it to.
+    stack = [[lst,0,len(toks),0,None,None]]
+    while len(stack) > 0:
+        f = stack[-1]
+        _lst,S,E,i = f[0],f[1],f[2],f[3]
+        if i >= E:
+            stack.pop()
+            blk = f[4]
+            if blk is not None and len(_lst) > 0:
+                f[5].append(blk)
+            continue
+        if toks[i] in closer_of:
+            if closers is None:
+                closers = get_closers(toks,closer_of)
+            ixE = closers[i]
+            if ixE == -1:
                 # malformed: skip this character and continue
-                i += 1
+                f[3] = i + 1
                 continue
-            # A quote or parenthesized text.Get content
-            content = _get_parse_blks(toks[i+1:E], tok_loc[i+1:E])
-            if len(content) > 0:
-                blk = ParseBlk(None,None)
-                blk.setSp(i+1,E-1)
-                blk.bracket = vcb.spell(toks[i])        
-                blk.sublst = content
-                lst.append(blk)
-        else:
-            E = i
-            while E+1 < len(toks) :
-                if is_opener(toks[E+1]):
-                    break;
-                E += 1
-            blk = ParseBlk(toks[i:E+1], tok_loc[i:E+1])
-            blk.setSp(i,E)
-            lst.append(blk)
-        i = E + 1
+            # A quote or parenthesized text. Get content
+            blk = ParseBlk(None,None)
+            blk.setSp(i+1-S,ixE-1-S)
+            blk.bracket = vcb.spell(toks[i])
+            blk.sublst = []
+            f[3] = ixE + 1
+            stack.append([blk.sublst,i+1,ixE,i+1,blk,_lst])
+            continue
+        ixE = i
+        while ixE+1 < E and toks[ixE+1] not in closer_of:
+            ixE += 1
+        blk = ParseBlk(toks,tok_loc,i,ixE)
+        blk.setSp(i-S,ixE-S)
+        _lst.append(blk)
+        f[3] = ixE + 1
     return lst
 
-def get_parse_blks(source_text,lno):
+# helpers for "normalize_ticks": word chars (as "\w" matches them),
+# a run of word chars, and the chars the function changes.
+_w_chars = frozenset('abcdefghijklmnopqrstuvwxyz' +
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+_re_w_run = re.compile(r'\w*')
+_re_tick = re.compile(r"['~]")
+
+def normalize_ticks(s):
+    """
+    Classify the single ticks in "s" as contraction ticks or quote
+    marks. Returns a copy of "s" in which quote-mark ticks are changed
+    to double-tick marks. Contraction ticks are kept. As a side
+    effect, any "~" in the text becomes a tick.
+
+    The classification was originally done as a series of rewrites:
+    contraction ticks were encoded as '~' by:
+        (\w+)'(\w+) -> \\1~\\2
+        ''(\w+)     -> '~\\1
+        (\w+)''     -> \\1~'
+        'em 'tis 'twas 'twill -> ~em ~tis ~twas ~twill
+    then remaining ticks became double-ticks, and '~' became a
+    tick. Here we apply the same rules (left to right, non-
+    overlapping, each rule seeing the result of the ones before) to
+    the tick positions alone, then build the result in one step.
+    """
+    ticks = []
+    specials = []
+    for m in _re_tick.finditer(s):
+        p = m.start()
+        specials.append(p)
+        if s[p] == "'":
+            ticks.append(p)
+    if len(specials) == 0:
+        return s
+    N = len(s)
+    w = _w_chars
+    # contraction ticks
+    contract = set()
+    # (\w+)'(\w+)
+    ixE = 0
+    for p in ticks:
+        if p-1 >= ixE and s[p-1] in w and p+1 < N and s[p+1] in w:
+            contract.add(p)
+            ixE = _re_w_run.match(s,p+1).end()
+    # ''(\w+)
+    ixE = 0
+    for p in ticks:
+        if p < ixE or p in contract:
+            continue
+        q = p+1
+        if q+1 < N and s[q] == "'" and q not in contract and \
+            s[q+1] in w:
+            contract.add(q)
+            ixE = _re_w_run.match(s,q+1).end()
+    # (\w+)''
+    ixE = 0
+    for p in ticks:
+        if p in contract:
+            continue
+        if p-1 >= ixE and s[p-1] in w and p+1 < N and \
+            s[p+1] == "'" and p+1 not in contract:
+            contract.add(p)
+            ixE = p+2
+    # some irregular forms
+    for p in ticks:
+        if p not in contract and (s.startswith('em',p+1) or
+            s.startswith('tis',p+1) or s.startswith('twas',p+1) or
+            s.startswith('twill',p+1)):
+            contract.add(p)
+    # build the result
+    parts = []
+    S = 0
+    for p in specials:
+        parts.append(s[S:p])
+        if s[p] == '~' or p in contract:
+            parts.append("'")
+        else:
+            parts.append('"')
+        S = p+1
+    parts.append(s[S:])
+    return ''.join(parts)
+
+def get_parse_blks(source_text,lno,col=1):
     """
     Break source into a sequence of blocks for parsing. "sourceText"
-    is a chunk taken from some larger text. "lno" gives the line
-    number at which this chunk starts.
+    is a chunk taken from some larger text. "lno" and "col" give the
+    line and column at which this chunk starts.
     """
-    global lno_map, col_map, src
-    # create copy of source and get the line and column mappings.
+    global src_lno, src_col, nl_offsets, src
+    # create copy of source and record the newlines, for the line and
+    # column mapping.
     src = source_text[:]
-    lno_map = []
-    col_map = []
-    col = 1
-    for c in src:
-        lno_map.append(lno)
-        col_map.append(col)
-        col += 1
-        if c == '\n':
-            lno += 1
-            col = 1
+    src_lno = lno
+    src_col = col
+    nl_offsets = new_buf()
+    ix = src.find('\n')
+    while ix != -1:
+        nl_offsets.append(ix)
+        ix = src.find('\n',ix+1)
     # Some texts use single ticks as quote marks, creating confusion
     # between quote marks and contraction ticks. So we change
-    # single-tick quote marks to double-tick marks. First create a version
-    # of the source in which contraction ticks are encoded to '~'.
-    src = src[:]
-    src = re.compile(r"(\w+)'(\w+)").sub(r'\1~\2',src)
-    src = re.compile(r"''(\w+)").sub(r"'~\1",src)
-    src = re.compile(r"(\w+)''").sub(r"\1~'",src)
-    # some irregular forms
-    src = src.replace("'em","~em")
-    src = src.replace("'tis","~tis")
-    src = src.replace("'twas","~twas")
-    src = src.replace("'twill","~twill")
-    # any remaining single ticks are treated as quotes: convert
-    # to standard double-quote mark convention
-    src = src.replace("'","\"")
-    # change '~' back to single tick
-    src = src.replace("~","'")
+    # single-tick quote marks to double-tick marks.
+    src = normalize_ticks(src)
     # lex the source
     toks,tok_loc = lex()
     # create the parse blocks
     return _get_parse_blks(toks,tok_loc)        
 
+# Splitting oversized sections. For the split, we scan for sentence
+# terminators, quotes and brackets, and count words and other
+# characters as tokens.
+_re_split = re.compile(r'[.!?]+|["()\[\]{}]|[^\s.!?"()\[\]{}]+')
+
+def split_section(text,max_toks):
+    """
+    A section with no blank or indented lines (OCR output, say) can
+    be very long. This splits section text into chunks of about
+    "max_toks" tokens (an estimate) at most, cutting only at the end
+    of a sentence: after a terminator ("." "!" "?"), or a quote that
+    closes after one, that's followed by white space. We prefer
+    sentence ends outside quotes and brackets. But a stray quote or
+    bracket (common in OCR text) would leave the rest of the section
+    looking quoted, so if a chunk has no such end within the budget,
+    and the next one isn't in sight, we cut at the last sentence end
+    inside quotes or brackets. A sentence longer than "max_toks"
+    isn't split. Returns the start offsets of the chunks (the first
+    is 0).
+    """
+    # quote-mark ticks become double-ticks: this doesn't move
+    # anything.
+    s = normalize_ticks(text)
+    N = len(s)
+    # Find the sentence ends: (offset, tokens up to there, is it
+    # outside quotes and brackets?)
+    ends = []
+    n = 0
+    depth = 0
+    in_quote = False
+    prv_end = False
+    for m in _re_split.finditer(s):
+        c = s[m.start()]
+        n += 1
+        is_end = False
+        if c == '"':
+            in_quote = not in_quote
+            # a quote that closes after a terminator
+            is_end = not in_quote and prv_end
+        elif c == '(' or c == '[' or c == '{':
+            depth += 1
+        elif c == ')' or c == ']' or c == '}':
+            if depth > 0:
+                depth -= 1
+        elif c == '.' or c == '!' or c == '?':
+            is_end = True
+        prv_end = c == '.' or c == '!' or c == '?'
+        E = m.end()
+        if is_end and (E == N or s[E].isspace()):
+            ends.append((E,n,depth == 0 and not in_quote))
+    # Cut the chunks. "n_cut" is the token count at the last cut.
+    # For the current chunk, "best" is the last end outside quotes
+    # and brackets, and "fallback" the last end after that (offset
+    # and token count, or None).
+    cuts = [0]
+    n_cut = 0
+    best = None
+    fallback = None
+    if len(ends) == 0 or ends[-1][0] != N:
+        ends.append((N,n,True))
+    for ix,n,protected in ends:
+        if n - n_cut > max_toks:
+            cut = best
+            if cut is None and not protected:
+                cut = fallback
+            if cut is not None and n > cut[1]:
+                cuts.append(cut[0])
+                n_cut = cut[1]
+                if fallback is not None and fallback[0] <= cut[0]:
+                    fallback = None
+                best = None
+        if protected:
+            best = (ix,n)
+            fallback = None
+        else:
+            fallback = (ix,n)
+    return cuts
+
 # Unit testing 
 def _ut_lex_parse_blks(txt):
     blks = get_parse_blks(txt,1)
     print_blklst(blks,0)
+
+def _ut_loc():
+    """
+    test "get_loc" on the token spans that "pg.build_graph" gives the
+    parser: a span runs for the length of the token's spelling, which
+    can go past the end of the text ("'em" is rewritten as "them").
+    The old per-character maps raised IndexError here.
+    """
+    for txt in ("don't  ''quoted'' leave","leave 'em","'em",
+        "don't  ''quoted'' leave 'em","a\nleave 'em"):
+        ok = True
+        for tok,S in _ut_toks(get_parse_blks(txt,1)):
+            E = S + len(vcb.spell(tok)) - 1
+            lnoS,colS = get_loc(S)
+            lnoE,colE = get_loc(E)
+            li = txt.split('\n')[lnoS-1]
+            ok = ok and lnoS == lnoE and colS <= colE and \
+                li[colS-1] == txt[S]
+        if ok:
+            print 'PASS get_loc %r' % txt
+        else:
+            print 'FAIL get_loc %r' % txt
+
+def _ut_toks(blks):
+    """ (token,source index) for the tokens in a list of blocks """
+    lst = []
+    for b in blks:
+        if b.sublst is not None:
+            lst.extend(_ut_toks(b.sublst))
+        else:
+            for i in range(b.tok_S,b.tok_E+1):
+                lst.append((b.toks[i],b.tok_loc[i]))
+    return lst
+
+def _ut_split_section():
+    """ test "split_section": print PASS or FAIL for each case """
+    sents = 'Dogs bark loudly. '*20
+    cases = (
+        # one sentence per chunk; no cuts in quotes or parens
+        ('A b. "C d." E (f. g) h! I j',1,[0,4,11,23]),
+        ("He said 'Stop.' Then he left. OK",2,[0,15,29]),
+        # whole sentences, up to the budget
+        (sents,10,[0]+range(35,len(sents)-1,36)),
+        # a sentence longer than the budget isn't split
+        ('A b c d e f. G h.',3,[0,12]),
+        ('A b. C d. ',1,[0,4]),
+        # a stray quote or bracket doesn't stop the split
+        ('He said "hi. ' + sents,10,[0]+range(30,len(sents)+12,36)),
+        ('He said (hi. ' + sents,10,[0]+range(30,len(sents)+12,36)),
+        ('',3,[0]))
+    for txt,max_toks,expect in cases:
+        cuts = split_section(txt,max_toks)
+        if cuts == expect:
+            print 'PASS split_section %r %d' % (txt[:16],max_toks)
+        else:
+            print 'FAIL split_section %r %d: %r' % (txt[:16],max_toks,cuts)
+
+def _ut_bench(fn,n_iter=10):
+    """
+    lexer throughput: time "scan" and "scan_re" on the text in file
+    "fn", and check they agree.
+    """
+    global src
+    fp = open(fn)
+    src = fp.read()
+    fp.close()
+    results = []
+    for scanner in (scan,scan_re):
+        best = None
+        for i in range(n_iter):
+            # start each run with the same vocabulary
+            vcb.reset_overlay()
+            t = time.time()
+            res = scanner()
+            t = time.time() - t
+            if best is None or t < best:
+                best = t
+        results.append(res)
+        print '%s: %.4f secs, %.0f KB/sec' % \
+            (scanner.__name__,best,len(src)/(1024.0*max(best,1e-6)))
+    if results[0] != results[1]:
+        print 'scanners disagree!'
+    _ut_bench_nest()
+
+def _ut_bench_nest(n=4000):
+    """
+    parse block throughput on deep nesting: "n" nested parens, and
+    "n" stray openers. The time should grow linearly with "n".
+    """
+    for name,txt in (('nested','('*n + 'x' + ')'*n),('stray','( x '*n)):
+        vcb.reset_overlay()
+        t = time.time()
+        blks = get_parse_blks(txt,1)
+        t = time.time() - t
+        depth = 0
+        while len(blks) == 1 and blks[0].sublst is not None:
+            blks = blks[0].sublst
+            depth += 1
+        print '%s (%d): %.4f secs, depth %d' % (name,n,t,depth)
     
 # unit test: tokenize some text and print result
 if __name__== '__main__':
@@ -461,8 +949,13 @@ if __name__== '__main__':
     fn = os.path.join(dn,"msp.dat")
     serializer.init(fn,'r')
     version = serializer.decode_str()
+    serializer.begin_section('vcb')
     vcb.serialize("r")
     serializer.fini()
+    if len(sys.argv) == 3 and sys.argv[1] == '-bench':
+        # python lexer.py -bench <file>
+        _ut_bench(sys.argv[2])
+        sys.exit(0)
 ##    # start dev code
 ##    vcb.print_wrd_info('strongest')
 ##    # end dev code
@@ -473,4 +966,6 @@ if __name__== '__main__':
 """
     txt = txt.strip()
     _ut_lex_parse_blks(txt)
+    _ut_loc()
+    _ut_split_section()
 
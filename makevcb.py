@@ -24,6 +24,7 @@ from vcb import WordVariant,RewriteRules
 import serializer
 import parser
 import os
+import sys
 
 
 # rewrite rules. We collect rules of the form
@@ -71,6 +72,7 @@ def define_rewrite_rules(rules):
                 lst.insert(ix_insert,rix)
             else:
                 lst.append(rix)
+    rules.compile()
 
 def add_prep_verb_fitness(terms):
     """ add a prep->{verb} mapping """
@@ -321,20 +323,57 @@ def create_vcb():
     define_rewrite_rules(vcb.rwrules)
 
 if __name__== '__main__':
+    # options:
+    # -v1 : write "msp.dat" in the version 1 (byte stream) format
+    # -convert : rewrite "msp.dat" in the requested format, without
+    # re-creating the vocabulary (the inflection table is recreated).
+    # Use this to convert a version 1 file to version 2.
+    # -spindex : after writing "msp.dat", read it back with lookups
+    # going through the spelling index, and run the interactive test
+    # on that.
+    fmt = serializer.FMT_V2
+    convert = False
+    sp_index = False
+    for a in sys.argv[1:]:
+        if a == '-v1':
+            fmt = serializer.FMT_V1
+        elif a == '-convert':
+            convert = True
+        elif a == '-spindex':
+            sp_index = True
+        else:
+            print 'unknown option: ' + a
+            sys.exit(1)
     # read "msp.dat"
     serializer.init("msp.dat",'r')
     parser.serialize('r')
     serializer.fini()
+    if convert:
+        # the inflection table and spelling index are derived from
+        # the vocabulary: we recreate them.
+        vcb.create_inflections()
+        vcb.create_sp_index()
+        serializer.init("msp.dat",'w',fmt)
+        parser.serialize('w')
+        serializer.fini()
+        print 'converted "msp.dat" to version %d' % fmt
+        sys.exit(0)
     # re-create the vocabulary from the ascii file "lexicon.txt"
     create_vcb()
     assign_synclasses()
+    vcb.create_inflections()
+    vcb.create_sp_index()
     # write out "msp.dat"
-    serializer.init("msp.dat",'w')
+    serializer.init("msp.dat",'w',fmt)
     parser.serialize('w')
     serializer.fini()
     print 'rewrote "msp.dat"'
     #vcb.printSynClasses()
     vcb.print_rewrite_rules()    
+    if sp_index:
+        serializer.init("msp.dat",'r')
+        parser.serialize('r',False,True)
+        serializer.fini()
     # enable this code to test interactively
     print 'Testing vocab: enter "q" to quit'
     vcb.unit_test()
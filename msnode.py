@@ -150,6 +150,9 @@ class Nd:
         self.lineE = -1
         self.colE = -1
         self.blank = -1
+        # For a top-level node: offset in the source of the section
+        # that contains its text (a byte offset, for a file).
+        self.offset = -1
 
     def check_vp(self,bitmask):
         """ test verb props """
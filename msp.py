@@ -15,59 +15,269 @@
 from defs import *
 import parser
 import vcb
+import source
 import serializer
 import re
 import sys
 import os
+import gc
+import traceback
 
 """
 Main script for the msparse package. To parse source text represented
 as a string, use "parseString". To parse the entire contents of a file,
 use "parseFile". To parse and process the contents of a very large
-file use "processFile".
+file use "processFile", or iterate over its sections with "parse_iter".
+
+These functions use a default parser, which reads its tables from
+"msp.dat" on first use. A client that wants to control when (and from
+where) the tables are read can create a parser explicitly, using
+"Parser.load", and call its methods.
 """
 
-# read the serialized vocabulary and grammar rules in "msp.dat".
-# This code expects the file to reside in the same directory
-# as this file.
-try:
-    serializer.init('msp.dat','r')
-    parser.serialize('r')
-    serializer.fini()
-except:
-    print "could not read initialization file \"msp.dat\""
-    print "Exception: %s\n" % sys.exc_info()[0]
-    sys.exit(1)
+class Parser():
+    """
+    A parser: owns a vocabulary and a set of parse tables, read from
+    a serialization file. Create with "Parser.load".
+    """
+    def __init__(self,tables,fn):
+        # tables: see "parser.get_tables"
+        self.tables = tables
+        # the file the tables were read from
+        self.fn = fn
+        # token budget for sections (see "set_max_sect_toks")
+        self.max_sect_toks = None
+
+    @classmethod
+    def load(cls,fn='msp.dat',lazy=True,cache=False,sp_index=False):
+        """
+        Read the vocabulary and parse tables in "fn". If "lazy" is
+        True, the tables for the parse transforms are read on first
+        use. If "cache" is True, we read the tables from the startup
+        cache for "fn", creating it if it's missing or stale (see
+        "parser.read_cache"). If "sp_index" is True, vocabulary
+        lookups go through the spelling index in "fn", which takes
+        less memory than a dict but is slower (see "vcb.serialize").
+        The cache holds the plain tables: "sp_index" applies when we
+        read "fn".
+        """
+        saved = parser.get_tables()
+        try:
+            parser.new_tables()
+            key = parser.get_cache_key(fn) if cache else None
+            if not (cache and parser.read_cache(fn,key)):
+                parser.new_tables()
+                serializer.init(fn,'r')
+                parser.serialize('r',lazy and not cache,sp_index)
+                serializer.fini()
+                if cache:
+                    parser.write_cache(fn,key)
+            return cls(parser.get_tables(),fn)
+        finally:
+            parser.set_tables(saved)
+
+    def activate(self):
+        """
+        Install our tables as the current tables (the parse code
+        reads the tables from module state).
+        """
+        parser.set_tables(self.tables)
+
+    def load_all(self):
+        """ read any tables deferred by a lazy load """
+        self.activate()
+        for x in parser.xfrms:
+            x.load()
+
+    def share(self):
+        """
+        Prepare our tables to be shared by forked worker processes.
+        After a fork, the parent's memory is shared copy-on-write: a
+        page is copied as soon as a child writes to it. Reference
+        counting and garbage collection write to objects, so we read
+        any deferred tables, compact them (see
+        "parser.compact_tables"), and run a full collection. That
+        leaves the tables in the oldest gc generation, with tuples
+        and dictionaries of ints and str's untracked.
+        """
+        self.activate()
+        parser.compact_tables()
+        self.tables = parser.get_tables()
+        gc.collect()
+
+    def set_overlay_max(self,max_n):
+        """
+        Entries for unknown words go in an overlay on our vocabulary.
+        By default (max_n None) the overlay is dropped at the start of
+        each parse. Otherwise it's shared by parses, and bounded to
+        "max_n" entries (see "vcb.Overlay").
+        """
+        self.activate()
+        vcb.set_overlay_max(max_n)
+
+    def set_max_sect_toks(self,n):
+        """
+        A section with no blank or indented lines (OCR output, say)
+        can be very long. If "n" is not None, sections longer than
+        about "n" tokens are split at sentence ends, and the chunks
+        parsed one at a time (see "lexer.split_section"). By default
+        (None) sections are parsed whole.
+        """
+        self.max_sect_toks = n
+
+    def get_overlay_stats(self):
+        """ get overlay metrics (see "vcb.get_overlay_stats") """
+        self.activate()
+        return vcb.get_overlay_stats()
+
+    def get_expansion_stats(self):
+        """
+        get metrics for the lexer's cache of contractions and
+        abbreviations (see "vcb.get_expansion_stats")
+        """
+        self.activate()
+        return vcb.get_expansion_stats()
+
+    def parse_string(self,text,loc=True):
+        """
+        Parse input text. Returns list of parse nodes. If "loc" is
+        False, the nodes don't get source locations.
+        """
+        self.activate()
+        return parser.parse_src(text,None,-1,loc,
+            max_sect_toks=self.max_sect_toks)
+
+    def parse_file(self,fn,loc=True):
+        """
+        Parse input file. Returns list of parse nodes. If "loc" is
+        False, the nodes don't get source locations.
+        """
+        self.activate()
+        fp = source.open_file(fn)
+        nds = parser.parse_src(fp,None,-1,loc,
+            max_sect_toks=self.max_sect_toks);
+        fp.close()
+        return nds
+
+    def process_file(self,fn,delegate=None,maxlines=-1,loc=True,
+            checkpoint=None,checkpoint_every=100,resume_from=None):
+        """
+        Read and parse the file "fn" in sections, passing the parse
+        of each section over to a delegate for processing. "maxlines"
+        determines the size of the sections: if a given section
+        exceeds "maxlines", we continue reading and parsing until
+        we hit a blank or indented line, then declare the section
+        complete and parse it. The object here is to support the
+        processing of very large files, without blowing the host
+        memory resources. If "loc" is False, the nodes don't get
+        source locations.
 
-def parse_string(text):
+        For long runs, a checkpoint can be written to the file
+        "checkpoint", every "checkpoint_every" sections. A run
+        restarted with "resume_from" set to that file carries on
+        where the checkpoint was written (see "parser.parse_src").
+        """
+        self.activate()
+        fp = source.open_file(fn)
+        nds = parser.parse_src(fp,delegate,maxlines,loc,
+            checkpoint,checkpoint_every,resume_from,self.max_sect_toks);
+        fp.close()
+
+    def parse_iter(self,content,loc=True,
+            checkpoint=None,checkpoint_every=100,resume_from=None):
+        """
+        Parse "content" -- a str, an open file, or a memory map of a
+        file (see "source.open_file") -- a section at a time. This is
+        a generator, yielding a "parser.Section" for each section: its
+        list of parse nodes ("nds"), line number, indent, and count of
+        preceding blank lines. If "loc" is False, the nodes don't get
+        source locations. "checkpoint", "checkpoint_every" and
+        "resume_from" are as for "process_file".
+        """
+        sections = parser.parse_iter(content,loc,
+            checkpoint,checkpoint_every,resume_from,self.max_sect_toks)
+        while True:
+            # the caller may use other parsers between sections
+            self.activate()
+            try:
+                sect = sections.next()
+            except StopIteration:
+                return
+            yield sect
+
+# The default parser: created on first use, reading "msp.dat". This
+# code expects the file to reside in the same directory as this file.
+_default_parser = None
+# should the default parser use the startup cache?
+use_cache = False
+# should the default parser look words up through the spelling index?
+use_sp_index = False
+
+def get_parser():
+    """ get the default parser """
+    global _default_parser
+    if _default_parser is None:
+        _default_parser = Parser.load('msp.dat',True,use_cache,
+            use_sp_index)
+    return _default_parser
+
+def prefork(n,worker,p=None):
+    """
+    Preload-then-fork worker mode. We prepare the parser "p" (default
+    is the default parser) to share its tables (see "Parser.share"),
+    then fork "n" worker processes. Worker "i" calls "worker(p,i)",
+    then exits. Returns the list of worker pid's: the caller is
+    responsible for waiting on them.
+    """
+    if p is None:
+        p = get_parser()
+    p.share()
+    pids = []
+    for i in range(n):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                worker(p,i)
+            except:
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+        pids.append(pid)
+    return pids
+
+def parse_string(text,loc=True):
+    """
+    Parse input text. Returns list of parse nodes. If "loc" is
+    False, the nodes don't get source locations.
+    """
+    return get_parser().parse_string(text,loc)
+
+def parse_file(fn,loc=True):
     """
-    Parse input text. Returns list of parse nodes. 
+    Parse input file. Returns list of parse nodes. If "loc" is
+    False, the nodes don't get source locations.
     """
-    return parser.parse_src(text)
+    return get_parser().parse_file(fn,loc)
 
-def parse_file(fn):
+def parse_iter(content,loc=True,
+        checkpoint=None,checkpoint_every=100,resume_from=None):
     """
-    Parse input file. Returns list of parse nodes. 
+    Parse "content" (a str or file) a section at a time, yielding a
+    "parser.Section" for each. See "Parser.parse_iter".
     """
-    fp = open(fn,"r")
-    nds = parser.parse_src(fp);
-    fp.close()
-    return nds
+    return get_parser().parse_iter(content,loc,
+        checkpoint,checkpoint_every,resume_from)
 
-def process_file(fn,delegate=None,maxlines=-1):
+def process_file(fn,delegate=None,maxlines=-1,loc=True,
+        checkpoint=None,checkpoint_every=100,resume_from=None):
     """
     Read and parse the file "fn" in sections, passing the parse
-    of each section over to a delegate for processing. "maxlines"
-    determines the size of the sections: if a given section
-    exceeds "maxlines", we continue reading and parsing until
-    we hit a blank or indented line, then declare the section
-    complete and parse it. The object here is to support the
-    processing of very large files, without blowing the host
-    memory resources.
+    of each section over to a delegate for processing. See
+    "Parser.process_file".
     """
-    fp = open(fn,"r")
-    nds = parser.parse_src(fp,delegate,maxlines);
-    fp.close()
+    get_parser().process_file(fn,delegate,maxlines,loc,
+        checkpoint,checkpoint_every,resume_from)
 
 
 def to_xml(nds,loc):
@@ -87,6 +297,7 @@ def msp_test():
     """
     Test harness for msparse package. 
     """
+    global use_cache, use_sp_index
     # option: do we show location info in the xml?
     showloc = False
     # usage msg.
@@ -99,7 +310,8 @@ python msp.py options* [-i] [-f fn] [-qa]
 for text entered by the user.
 
 "-f" means parse contents of the file "fn", writing
-the results to "<fn-root>.xml" as XML.
+the results to "<fn-root>.xml" as XML. The file may
+be compressed (gzip, bzip2 or xz).
 
 "-qa" parses "qasrc.txt" and compares against "qaref.xml
 
@@ -108,13 +320,16 @@ the results to "<fn-root>.xml" as XML.
 options:
     -loc: include source locations attributes in xml nodes
     -trace: trace the parse (dev/test)
+    -cache: read the tables from a startup cache ("msp.dat.cache"),
+        creating it if needed
+    -spindex: look words up through the spelling index in "msp.dat"
+        (uses less memory, but is slower)
 
     """
     # start dev code
     # vcb.print_wrd_info('lines')
     # end dev code
 
-    
     # process args
     # Undocumented args are:
     # -printrules : print parse rules
@@ -125,12 +340,24 @@ options:
     if len(sys.argv) == 1:
         print usage
         sys.exit(1)
+    use_cache = '-cache' in sys.argv
+    use_sp_index = '-spindex' in sys.argv
+    # read the serialized vocabulary and grammar rules in "msp.dat".
+    try:
+        get_parser().activate()
+    except:
+        print "could not read initialization file \"msp.dat\""
+        print "Exception: %s\n" % sys.exc_info()[0]
+        sys.exit(1)
     i =1
     while i<len(sys.argv):  
         a = sys.argv[i]
         if a == '-h' or a == '-help' or a == '-0':
             print usage
             sys.exit(1)
+        if a == '-cache' or a == '-spindex':
+            i += 1
+            continue
         if a == '-lst':
             fplst = open('msp.lst','w')
             parser.printme(fplst)
@@ -169,7 +396,7 @@ options:
         fp = open('qaref.xml','r')
         ref_lines = fp.readlines()
         fp.close()
-        xml = to_xml(parse_file('qasrc.txt'),False)
+        xml = to_xml(parse_file('qasrc.txt',False),False)
         xml_lines = xml.split("\n")
         i = 0
         pass_test = True
@@ -193,14 +420,14 @@ options:
     if action == '-f' or action == '-process':
         fp = open(fn_out,'w')
         if action == '-f':
-            fp.write(to_xml(parse_file(fn_in),showloc))
+            fp.write(to_xml(parse_file(fn_in,showloc),showloc))
         else:
             def process_parse(nds):
                 for nd in nds:
                     if nd.get_subnode("exper") != None:
                         fp.write(nd.text + '\n')
                         fp.write(nd.summary() + '\n')
-            process_file(fn_in,process_parse,2)
+            process_file(fn_in,process_parse,2,False)
         print 'Created %s' % fn_out
         sys.exit(1)
     # Interactive mode
@@ -209,7 +436,7 @@ options:
         src = raw_input()
         if src == 'q' or src == 'quit':
             break
-        print to_xml(parse_string(src),showloc)
+        print to_xml(parse_string(src,showloc),showloc)
 
 if __name__== '__main__':
     msp_test()
@@ -15,7 +15,6 @@
 import pg
 from defs import *
 import vcb
-from vcb import sc_dct
 import serializer
 from seqmap import FSM
 from rematch import pnRE
@@ -223,6 +222,9 @@ class ReductXfrm(Xfrm):
     by a ReductXfrm.
     """
 
+    # our rules are data tables
+    tables = True
+
     # actions
     act_reduce = 0x1
     act_set_prop = 0x2
@@ -282,6 +284,13 @@ class ReductXfrm(Xfrm):
             self.sc = serializer.decode_intlst(8)
             self.act = serializer.decode_intlst(8)
 
+    def compact(self):
+        self.offS = serializer.compact_intlst(self.offS)
+        self.offE = serializer.compact_intlst(self.offE)
+        self.props = serializer.compact_intlst(self.props)
+        self.sc = serializer.compact_intlst(self.sc)
+        self.act = serializer.compact_intlst(self.act)
+
     def find_rule(self,e):
         matches = self.fsm.get_matches(e,True)
         if len(matches) > 0:
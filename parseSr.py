@@ -16,7 +16,6 @@ import pg
 from defs import *
 import lexer
 import vcb
-from vcb import sc_dct
 import serializer
 from rematch import *
 from xfrm import *
@@ -35,8 +34,7 @@ class BindPreps(Xfrm):
         # e is the prep to be bound
         ep = e
         prep = ep.get_wrd(0)
-        v0,fit0 = None,-1
-        v1,fit1 = None,-1
+        verbs = []
         ex = ep.prv
         # Walk left, to a max of 2 verbs; punctuation and
         # conjunctions terminate the walk.
@@ -44,15 +42,17 @@ class BindPreps(Xfrm):
             if ex.check_sc(WP_conj|WP_punct):
                 break
             if vcb.is_sc_for_verb(ex.sc):
-                if v0 is None:
-                    v0 = ex
-                    fit0 = vcb.get_prep_verb_fitness(prep,v0.get_vroot())
-                elif v1 is None:
-                    v1 = ex
-                    fit1 = vcb.get_prep_verb_fitness(prep,v1.get_vroot())
+                verbs.append(ex)
+                if len(verbs) == 2:
                     break
             ex  = ex.prv
+        if len(verbs) < 2:
+            # nothing to choose between
+            return e.prv
+        fit0,fit1 = vcb.get_prep_verb_fitness_lst(prep,
+            [v.get_vroot() for v in verbs])
         if fit1 > fit0:
+            v1 = verbs[1]
             ep.sc = vcb.lkup_sc("FarPrep")
             v1.set_vp(VP_farprep)
             return v1.prv
@@ -17,7 +17,6 @@ from defs import *
 from msnode import *
 import lexer
 import vcb
-from vcb import sc_dct
 import serializer
 from parseReduct import ReductXfrm, LeftReductXfrm
 from parseSr import *
@@ -25,6 +24,9 @@ from srxfrm import SrXfrm
 from source import *
 import xfrm
 from attribution import set_attributions
+import attribution
+from rematch import pnRE
+import hashlib
 import os
 import sys
 
@@ -63,22 +65,27 @@ def serialize_version(mode):
 def set_trace_parse(enable):
     xfrm.traceparse = enable
 
+def create_xfrms():
+    """ create the transforms (with empty tables) """
+    lst = []
+    lst.append(ReductXfrm('init'))
+    lst.append(LeftReductXfrm('leftinit'))
+    lst.append(LeftReductXfrm('queryhead'))
+    lst.append(ReductXfrm('vphr'))
+    lst.append(ReductXfrm('detphr'))
+    lst.append(ReductXfrm('conj'))
+    lst.append(BindPreps('bindPreps'))
+    lst.append(SrXfrm('sr'))
+    lst.append(QueryXfrm('query'))
+    lst.append(SvToQXfrm('svToQ'))
+    lst.append(InvertQXfrm('invertQ'))
+    lst.append(ValidateSpans('validateSpans'))
+    lst.append(InferSubjects('inferSubjects'))
+    lst.append(ReduceSrClauses('reduceSrClauses'))
+    return lst
+
 # the transforms
-xfrms = []
-xfrms.append(ReductXfrm('init'))
-xfrms.append(LeftReductXfrm('leftinit'))
-xfrms.append(LeftReductXfrm('queryhead'))
-xfrms.append(ReductXfrm('vphr'))
-xfrms.append(ReductXfrm('detphr'))
-xfrms.append(ReductXfrm('conj'))
-xfrms.append(BindPreps('bindPreps'))
-xfrms.append(SrXfrm('sr'))
-xfrms.append(QueryXfrm('query'))
-xfrms.append(SvToQXfrm('svToQ'))
-xfrms.append(InvertQXfrm('invertQ'))
-xfrms.append(ValidateSpans('validateSpans'))
-xfrms.append(InferSubjects('inferSubjects'))
-xfrms.append(ReduceSrClauses('reduceSrClauses'))
+xfrms = create_xfrms()
 
 def get_xfrm(name):
     """ get xfrm given name """
@@ -87,37 +94,198 @@ def get_xfrm(name):
             return x
     return None
 
-def serialize(mode):
-    """ read/write the parser (and vocabulary) """
+# The tables (vocabulary and transforms) are module state. To support
+# more than one set of tables in a process, a client can read tables
+# into a new set ("new_tables"), save it ("get_tables"), and later
+# reinstall it ("set_tables").
+
+def new_tables():
+    """ install new (empty) tables: vocabulary and transforms """
+    global xfrms
+    vcb.new_tables()
+    xfrms = create_xfrms()
+
+def get_tables():
+    """ get the current tables """
+    return (vcb.get_tables(),xfrms,version)
+
+def set_tables(tables):
+    """ install tables obtained from "get_tables" """
+    global xfrms,version
+    vcb_tables,xfrms,version = tables
+    vcb.set_tables(vcb_tables)
+
+def compact_tables():
+    """
+    Convert the current tables to compact forms: int lists become
+    arrays, and lists of short sequences become tuples. This reduces
+    the number of objects the garbage collector visits (and writes
+    to), which matters when the tables are shared by forked worker
+    processes (see "msp.prefork").
+    """
+    vcb.compact()
+    for x in xfrms:
+        x.load()
+        x.compact()
+
+def serialize(mode,lazy=False,sp_index=False):
+    """
+    read/write the parser (and vocabulary). Each transform's tables
+    are in a section of their own. If "lazy" is True (read mode), we
+    don't read those sections now: each transform reads its section
+    when it's first used. If "sp_index" is True (read mode), the
+    vocabulary's lookups go through the spelling index (see
+    "vcb.serialize").
+    """
     serialize_version(mode)
-    vcb.serialize(mode)    
+    serializer.begin_section('vcb')
+    vcb.serialize(mode,sp_index)
     for x in xfrms:
+        if not x.tables:
+            continue
+        if mode == 'w':
+            # if our read was deferred, complete it now.
+            x.load()
+        elif lazy and serializer.has_section(x.name):
+            x.defer_serialize()
+            continue
+        serializer.begin_section(x.name)
         x.serialize(mode)
+    # compiled attribution patterns: only the startup cache keeps these
+    if mode == 'w':
+        attribution.compile_res()
+        serializer.encode_index(pnRE.redct)
+    else:
+        redct = serializer.decode_index()
+        if redct is not None:
+            pnRE.redct.update(redct)
+    # The inflection table comes last: files written before it was
+    # added don't have it.
+    if mode == 'w':
+        if vcb.inflections is not None:
+            serializer.begin_section('inflections')
+            vcb.serialize_inflections(mode)
+    elif serializer.has_section('inflections') or \
+        (serializer.fmt != serializer.FMT_V2 and not serializer.at_end()):
+        serializer.begin_section('inflections')
+        vcb.serialize_inflections(mode)
+    # The spelling index is read by the dictionary, out of order: only
+    # version 2 files (which have a section directory) store it.
+    if mode == 'w' and serializer.fmt == serializer.FMT_V2:
+        vcb.serialize_sp_index(mode)
+
+# Startup cache. Reading "msp.dat" means rebuilding the lookup
+# dictionaries from the decoded lists; the cache ("msp.dat.cache",
+# next to the data file) is a marshal image of the fully built tables.
+# It's keyed by the SHA-1 of the data file, so a new "msp.dat" makes it
+# stale. The key also includes "cache_version": bump this when the
+# in-memory form of the tables changes.
+cache_version = 2
+
+def get_cache_key(fn):
+    """ get the cache key for data file "fn" """
+    fp = open(serializer.get_filepath(fn),'rb')
+    key = hashlib.sha1(fp.read()).hexdigest()
+    fp.close()
+    return '%d:%s' % (cache_version,key)
+
+def read_cache(fn,key):
+    """
+    Read the tables from the startup cache for data file "fn".
+    Returns False if there's no cache, or it's stale (the caller
+    should then read "fn").
+    """
+    cache_fn = fn + '.cache'
+    if not os.path.exists(serializer.get_filepath(cache_fn)):
+        return False
+    try:
+        serializer.init(cache_fn,'r')
+        try:
+            ok = serializer.fmt == serializer.FMT_CACHE and \
+                serializer.decode_str() == key
+            if ok:
+                serialize('r')
+        finally:
+            serializer.fini()
+        return ok
+    except Exception:
+        return False
+
+def write_cache(fn,key):
+    """
+    Write the current tables to the startup cache for data file "fn".
+    Failure (a read-only directory, say) is not an error: we just
+    don't have a cache. We write a temp file and rename it, so a
+    crash while writing, or a worker reading the cache while another
+    writes it, never sees a partial cache. The temp file name has our
+    process id: workers started together may all write the cache.
+    """
+    cache_fn = serializer.get_filepath(fn + '.cache')
+    fn_tmp = '%s.%d.tmp' % (fn + '.cache',os.getpid())
+    try:
+        serializer.init(fn_tmp,'w',serializer.FMT_CACHE)
+        try:
+            serializer.encode_str(key)
+            serialize('w')
+        finally:
+            serializer.fini()
+        if os.name == 'nt' and os.path.exists(cache_fn):
+            # (on Windows, rename won't replace a file)
+            os.remove(cache_fn)
+        os.rename(serializer.get_filepath(fn_tmp),cache_fn)
+    except (IOError,OSError,ValueError):
+        # (marshal raises ValueError for objects it can't write)
+        try:
+            os.remove(serializer.get_filepath(fn_tmp))
+        except OSError:
+            pass
 
 def printme(fp):
     """ print parser rules """
     if fp is None:
         fp = sys.stdout
     for x in xfrms:
+        x.load()
         x.printme(fp)
 
-def parse_src(content_provider,delegate=None,maxlines=-1):
+def parse_src(content_provider,delegate=None,maxlines=-1,loc=True,
+        checkpoint=None,checkpoint_every=100,resume_from=None,
+        max_sect_toks=None):
     """
     Parse source -- either a file or a str (but not both).
     If "delegate" is None, we return a list of parse nodes
     giving the parse. If delegate is defined, we read and
     parse the source in sections, passing the parse of each
-    section over to the delegate for processing.
+    section over to the delegate for processing. If "loc" is
+    False, we don't compute source locations for the nodes.
     This is the main entry function for parsing.
+
+    If "checkpoint" is given (a file name), we write a checkpoint
+    there once the delegate has processed at least
+    "checkpoint_every" sections since the last one. "resume_from"
+    (a checkpoint file name) starts the parse at the point the
+    checkpoint was written: see "source.write_checkpoint".
+
+    If "max_sect_toks" is not None, sections longer than this many
+    tokens (an estimate) are split into chunks at sentence ends, and
+    each chunk is parsed on its own (see "parse_section").
     """
     # The parse is a list of parse nodes
     nds = []
     # we parse in sections
     src = Source(content_provider)
+    n_sect = 0
+    if resume_from is not None:
+        state = read_checkpoint(resume_from)
+        src.set_state(state)
+        n_sect = state['n_sect']
+    n_sect_ckpt = n_sect
+    # Parse nodes hold spellings (not vocabulary indices), so entries
+    # for unknown words can be dropped once the nodes are created.
+    vcb.begin_parse()
     while src.get_section():
-        blklst = lexer.get_parse_blks(src.sect_text,src.sect_lno)
-        pnlst = parse_blklst(blklst,None)
-        nds.extend(get_parse_nodes(pnlst,None,-1))
+        nds.extend(parse_section(src,loc,max_sect_toks))
+        n_sect += 1
         # If a delegate is defined, pass the node collection
         # over the processing and start over.
         if delegate is not None and \
@@ -125,8 +293,86 @@ def parse_src(content_provider,delegate=None,maxlines=-1):
             # process the nodes, then start a new section
             delegate(nds)
             nds = []
+            vcb.begin_parse()
+            if checkpoint is not None and \
+                n_sect - n_sect_ckpt >= checkpoint_every:
+                write_checkpoint(checkpoint,src,n_sect)
+                n_sect_ckpt = n_sect
+    return nds
+
+class Section():
+    """
+    A parsed section of source (see "parse_iter"): the top-level
+    parse nodes, with the section's line number, indent, number of
+    preceding blank lines, and offset in the source.
+    """
+    def __init__(self,src,nds):
+        self.nds = nds
+        self.lno = src.sect_lno
+        self.indent = src.sect_indent
+        self.blank = src.sect_blank
+        self.offset = src.sect_offset
+
+def parse_section(src,loc=True,max_toks=None):
+    """
+    Parse the current section of Source "src". Returns the list of
+    (top-level) parse nodes. If "max_toks" is not None, a section
+    longer than this many tokens is parsed in chunks (see
+    "lexer.split_section").
+    """
+    text = src.sect_text
+    if max_toks is None:
+        cuts = [0]
+    else:
+        cuts = lexer.split_section(text,max_toks)
+    nds = []
+    # line number for the start of the current chunk
+    lno = src.sect_lno
+    for i in range(len(cuts)):
+        S = cuts[i]
+        if i > 0:
+            lno += text.count('\n',cuts[i-1],S)
+        E = cuts[i+1] if i+1 < len(cuts) else len(text)
+        # column for the start of the chunk
+        col = S - text.rfind('\n',0,S)
+        blklst = lexer.get_parse_blks(text[S:E],lno,col)
+        pnlst = parse_blklst(blklst,None)
+        nds.extend(get_parse_nodes(pnlst,None,-1,loc))
+    for nd in nds:
+        nd.offset = src.sect_offset
     return nds
 
+def parse_iter(content_provider,loc=True,
+        checkpoint=None,checkpoint_every=100,resume_from=None,
+        max_sect_toks=None):
+    """
+    Parse source -- either a file (or a memory map of one) or a str --
+    a section at a time. This is a generator: it yields a "Section"
+    as soon as the section is parsed. Entries for unknown words are
+    dropped after each section (see "vcb.begin_parse"), so memory use
+    doesn't grow with the size of the source. "checkpoint",
+    "checkpoint_every", "resume_from" and "max_sect_toks" are as for
+    "parse_src": a section counts as processed when the caller asks
+    for the next one.
+    """
+    src = Source(content_provider)
+    n_sect = 0
+    if resume_from is not None:
+        state = read_checkpoint(resume_from)
+        src.set_state(state)
+        n_sect = state['n_sect']
+    n_sect_ckpt = n_sect
+    vcb.begin_parse()
+    while src.get_section():
+        sect = Section(src,parse_section(src,loc,max_sect_toks))
+        yield sect
+        n_sect += 1
+        vcb.begin_parse()
+        if checkpoint is not None and \
+            n_sect - n_sect_ckpt >= checkpoint_every:
+            write_checkpoint(checkpoint,src,n_sect)
+            n_sect_ckpt = n_sect
+
 def parse_blklst(blklst,parent):
     """
     parse a list of blocks. Returns a list of Pn's.
@@ -157,6 +403,7 @@ def parse_blk(blk):
         pg.printme(None,"initial graph")
     for x in xfrms:
         try:
+            x.load()
             x.do_xfrm()
             if xfrm.traceparse:
                 pg.printme(None,"post " + x.name)
@@ -306,10 +553,11 @@ def remap_vp(v):
         msv |= VP.perfect
     return msv
 
-def get_parse_nodes(lst,parent,sr):
+def get_parse_nodes(lst,parent,sr,loc=True):
     """
     This method accepts a list of graph nodes, and returns a
-    corresponding list of parse nodes.
+    corresponding list of parse nodes. If "loc" is True, we set
+    the source locations for the nodes.
     """
     nds = []
     for e in lst:
@@ -330,11 +578,11 @@ def get_parse_nodes(lst,parent,sr):
         nds.append(nd)
         # get content for containder nodes (quotes and parens)
         if e.is_container():
-            nd.subnodes.extend(get_parse_nodes(e.sublst,nd,-1))
+            nd.subnodes.extend(get_parse_nodes(e.sublst,nd,-1,loc))
         # get subnodes
         for i in range(SR_nwordtoverb):
             if len(e.rel[i]) > 0 and remap_sr(i) != -1:
-                nd.subnodes.extend(get_parse_nodes(e.rel[i],nd,i))
+                nd.subnodes.extend(get_parse_nodes(e.rel[i],nd,i,loc))
         if len(e.head)>0:
             nd.head = vcb.spell(e.head)
         if len(e.verbs)>0:
@@ -346,12 +594,9 @@ def get_parse_nodes(lst,parent,sr):
         if e.vprops != 0:
             if form != NdForm.action:
                 nd.vprops = remap_vp(e.vprops)
-        locS = e.S
-        locE = e.E
-        nd.lineS = lexer.lno_map[locS]
-        nd.colS = lexer.col_map[locS]
-        nd.lineE = lexer.lno_map[locE]
-        nd.colE = lexer.col_map[locE]
+        if loc:
+            nd.lineS,nd.colS = lexer.get_loc(e.S)
+            nd.lineE,nd.colE = lexer.get_loc(e.E)
     return nds
 
 def do_attributions(nds):
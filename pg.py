@@ -38,7 +38,7 @@ class Pn (nd.Nd):
     words ("the boy"), linked together in a doubly-linked list to
     represent the source text.
     """
-    def __init__(self,tok_v,S,E):
+    def __init__(self,tok_v,S,E,attrs=None):
         nd.Nd.__init__(self,S,E)
         # identifier ("handle") for test/dev
         self.h = -1
@@ -74,15 +74,19 @@ class Pn (nd.Nd):
         for i in range(0,SR_nwordtoverb):
             self.rel.append([])
         if tok_v != -1:
+            # "attrs" is (vprops,def,synclass) for the word, as
+            # obtained by "vcb.get_entry_attrs".
+            if attrs is None:
+                attrs = (vcb.get_vprops(tok_v),vcb.get_def(tok_v),
+                    vcb.synclass[tok_v])
+            vp,_def,sc = attrs
             self.wrds.append(tok_v)
-            self.sc = self.compute_synclass(tok_v)
+            self.sc = self.compute_synclass(tok_v,sc)
             if vcb.is_sc_for_verb(self.sc):
                 # "Is" is defined as "is", which is in turn defined
                 # as "be".
-                _def = vcb.get_def(tok_v)
-                _def = vcb.get_def(_def)
-                self.verbs.append(_def)
-                self.vprops = self.compute_verb_props(tok_v)
+                self.verbs.append(vcb.get_def(_def))
+                self.vprops = compute_verb_props(tok_v,vp,_def)
         # In general the "extent" of a node is just the node. But if
         # this is the verb in a verb expression, then its extent runs
         # from its left-most scope term to its right-most scope term.
@@ -95,8 +99,11 @@ class Pn (nd.Nd):
         # parse graph node
         self.msnode = None
 
-    def compute_synclass(self,tok_v):
-        """ compute the "sc" value for a node """
+    def compute_synclass(self,tok_v,sc=None):
+        """
+        compute the "sc" value for a node. "sc" is the vocabulary
+        synclass for the word, if the caller has it.
+        """
         sp = vcb.spell(tok_v).lower()
         c = sp[0]
         if sp == '\'s':
@@ -111,32 +118,9 @@ class Pn (nd.Nd):
             # numerals lex as weak-determinants: "I saw 123,000 people"
             return vcb.lkup_sc("Num")
         # a vocabulary word
-        return vcb.synclass[tok_v]
-
-    def compute_verb_props(self,tok):
-        """ get verb props (VP_xxx) for a parse node """
-	# MUSTDO: rewrite. Simple assignment?
-        p = 0
-        if vcb.check_vp(tok,VP_root):
-            p |= VP_root
-        elif vcb.check_vp(tok,VP_negcontraction):
-            p |= VP_neg
-        if  vcb.check_vp(tok,VP_past|VP_participle):
-            p |= VP_past
-        else:
-            p |= VP_present
-        if vcb.check_vp(tok,VP_gerund):
-            p |= VP_gerund
-        if vcb.check_vp(tok,VP_adj):
-            p |= VP_adj
-        if vcb.check_vp(tok,VP_participle):
-            p |= VP_participle
-        # remaining verb props are based on the root of the verb. This
-        # is given by its definition.
-        tok_def = vcb.get_def(tok)
-        if vcb.check_vp(tok_def,VP_vpq):
-            p |= VP_prelude
-        return p
+        if sc is None:
+            return vcb.synclass[tok_v]
+        return sc
 
     def get_wrd(self,i):
         """ get wrd "i" """
@@ -324,13 +308,41 @@ class Pn (nd.Nd):
                 fp.write(self.dump_nd_lst(SRids[i],self.rel[i]))
 	fp.write('\n')
 
+def compute_verb_props(tok,vp,tok_def):
+    """
+    get verb props (VP_xxx) for word "tok", given its vocabulary
+    vprops ("vp") and its definition ("tok_def").
+    """
+    if tok == 0:
+        vp = 0
+    p = 0
+    if (vp & VP_root) != 0:
+        p |= VP_root
+    elif (vp & VP_negcontraction) != 0:
+        p |= VP_neg
+    if (vp & (VP_past|VP_participle)) != 0:
+        p |= VP_past
+    else:
+        p |= VP_present
+    if (vp & VP_gerund) != 0:
+        p |= VP_gerund
+    if (vp & VP_adj) != 0:
+        p |= VP_adj
+    if (vp & VP_participle) != 0:
+        p |= VP_participle
+    # remaining verb props are based on the root of the verb. This
+    # is given by its definition.
+    if vcb.check_vp(tok_def,VP_vpq):
+        p |= VP_prelude
+    return p
+
 # phrase factory. Do not inline this code -- you will break the tools
 # that build the parse tables.
 pn_enum = 0
-def pn_factory(tok_v,S,E):
+def pn_factory(tok_v,S,E,attrs=None):
     """ create phrase with given props """
     global pn_enum
-    e = Pn(tok_v,S,E)
+    e = Pn(tok_v,S,E,attrs)
     e.h = pn_enum
     pn_enum += 1
     return e
@@ -391,14 +403,19 @@ def build_graph(parseblk):
     # tokenize the text
     toks = parseblk.toks
     tok_loc = parseblk.tok_loc
+    S = parseblk.tok_S
+    E = parseblk.tok_E
     pn_enum = 0
     eS = eE = None
-    for i in range(0,len(toks)):
+    # get the vocabulary attributes for the block in one call
+    vprops,_def,synclass = vcb.get_entry_attrs(toks,S,E)
+    for i in range(S,E+1):
         # The span of a node gives start and end index of the region
         # in the source text spanned by e.
         ixS = tok_loc[i]
         sp = vcb.spell(toks[i])
-        e = pn_factory(toks[i], ixS, ixS+len(sp)-1)
+        e = pn_factory(toks[i], ixS, ixS+len(sp)-1,
+            (vprops[i-S],_def[i-S],synclass[i-S]))
         # linked-list bookkeeping
         if eS == None:
             eS = eE = e
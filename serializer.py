@@ -13,7 +13,11 @@
 # limitations under the License.
 
 import array
+import marshal
+import mmap
 import os
+import struct
+import sys
 
 """
 We use two files of serialized data structures. "vcb.dat" initializes
@@ -21,15 +25,51 @@ the vocabulary, and "parser.dat" provides the parse rules. We don't
 use language specific serialization methods, because the package is
 ported to multiple languages, so it's best to create our own binary
 format.
+
+There are two versions of the format. Version 1 is a plain byte
+stream: every int is written big-endian, one at a time. Version 2
+starts with a header ("MSP2" plus the offset of the section
+directory) and stores int lists, lists of int-lists, and string lists
+as fixed-width, 4-byte aligned blocks in little-endian order. A
+version 2 file is memory-mapped on read, and each block is copied out
+of the map in a single call (no per-element decoding). The reader
+detects the version from the header, so both versions can be read.
+
+Sections: a writer can break the data into named sections (see
+"begin_section"). A version 2 file records the offset of each section
+in a directory at the end of the file, so a reader can seek straight
+to the section it wants. This lets the parser defer reading the
+tables for a transform until the transform is first used.
+
+There's also a cache format ("FMT_CACHE"). This is not portable: it's
+a python marshal image of the decoded values, used as a startup cache.
+It also stores derived mappings (see "encode_index"), which the other
+formats leave for the reader to rebuild.
 """
+# format versions
+FMT_V1 = 1
+FMT_V2 = 2
+FMT_CACHE = 3
+# magic bytes at the start of a version 2 file
+v2_magic = 'MSP2'
+# magic bytes at the start of a cache file
+cache_magic = 'MSPC'
+# size of the version 2 header
+v2_header_len = 8
 # file name
 fn = ''
 # mode ('r' or 'w')
 mode = ''
-# array of bytes, written to/read from file
+# format version of the file being read/written
+fmt = FMT_V2
+# array of bytes, written to/read from file. For version 2 reads,
+# this is the memory-mapped file. For the cache format, it's a list
+# of values.
 ary = None
 # serialization index
 ix_ary = 0
+# section directory: mapping, section name -> offset
+sections = {}
 
 def get_filepath(_fn):
     """
@@ -39,70 +79,252 @@ def get_filepath(_fn):
     dn = os.path.dirname(os.path.realpath(__file__))
     return os.path.join(dn,_fn)
 
-def init(_fn,_mode):
-    """ init the serialization: specify file name and mode ('r' or 'w') """
-    global fn,mode,ary,ix_ary
+def init(_fn,_mode,_fmt=FMT_V2):
+    """
+    init the serialization: specify file name and mode ('r' or 'w').
+    "_fmt" gives the format version for writes; on reads the version
+    is taken from the file.
+    """
+    global fn,mode,fmt,ary,ix_ary,sections
     fn = _fn
     mode = _mode
+    fmt = _fmt
     ary = array.array('B')
     ix_ary = 0
+    sections = {}
     if mode == 'r':
         fp = open(get_filepath(fn),"rb")
-        ary.fromstring(fp.read())
+        magic = fp.read(len(v2_magic))
+        if magic == cache_magic:
+            fmt = FMT_CACHE
+            ary = marshal.loads(fp.read())
+        elif magic == v2_magic:
+            fmt = FMT_V2
+            ary = mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ)
+            ix_dir = struct.unpack_from('<I',ary,len(v2_magic))[0]
+            if ix_dir != 0:
+                ix_ary = ix_dir
+                for i in xrange(_decode_count()):
+                    ix = _decode_count()
+                    sections[decode_str()] = ix
+            ix_ary = v2_header_len
+        else:
+            fmt = FMT_V1
+            fp.seek(0)
+            ary.fromstring(fp.read())
         fp.close()
+    elif fmt == FMT_V2:
+        ary.fromstring(v2_magic)
+        ary.fromstring('\0' * (v2_header_len - len(v2_magic)))
+    elif fmt == FMT_CACHE:
+        ary = []
 
 def fini():
-    """ complete the serialization """
+    """
+    complete the serialization. The serialization is closed even if
+    this fails.
+    """
     global mode, ary
+    try:
+        if mode == 'w':
+            if fmt == FMT_V2 and len(sections) > 0:
+                # write the section directory, and record its offset
+                # in the header
+                _align()
+                ix_dir = len(ary)
+                _encode_count(len(sections))
+                for name,ix in sections.iteritems():
+                    _encode_count(ix)
+                    encode_str(name)
+                hdr = array.array('B',struct.pack('<I',ix_dir))
+                ary[len(v2_magic):v2_header_len] = hdr
+            if fmt == FMT_CACHE:
+                data = cache_magic + marshal.dumps(ary)
+            else:
+                data = ary.tostring()
+            fp = open(get_filepath(fn),"wb")
+            try:
+                fp.write(data)
+            finally:
+                fp.close()
+        elif fmt == FMT_V2:
+            ary.close()
+    finally:
+        ary = None
+
+def begin_section(name):
+    """
+    Begin section "name". On writes, this records the offset of the
+    section in the directory. On reads, we move to the start of the
+    section. Version 1 has no sections, so this is a no-op.
+    """
+    global ix_ary
+    if fmt != FMT_V2:
+        return
+    _align()
     if mode == 'w':
-        fp = open(get_filepath(fn),"wb")
-        fp.write(ary.tostring())
-        fp.close()
-    ary = None
-# int encodings
+        sections[name] = len(ary)
+    elif name in sections:
+        ix_ary = sections[name]
+
+def has_section(name):
+    """ is there a section "name"? (read mode) """
+    return name in sections
+
+def at_end():
+    """
+    Have we read all the data? (read mode). Version 2 files end with
+    the section directory: use "has_section" for these.
+    """
+    return ix_ary >= len(ary)
+
+def get_state():
+    """
+    Get the state of the serialization, so a nested read can be done
+    (see "set_state").
+    """
+    return (fn,mode,fmt,ary,ix_ary,sections)
+
+def set_state(state):
+    """ restore state saved by "get_state" """
+    global fn,mode,fmt,ary,ix_ary,sections
+    fn,mode,fmt,ary,ix_ary,sections = state
+
+# Version 2 blocks. A block starts on a 4-byte boundary. Elements are
+# written little-endian, and are read back by copying the block out
+# of the memory-mapped file into an array.
+
+# array typecodes for 8, 16 and 32 bit elements. 32 bit elements are
+# read as signed ints: unsigned 32 bit arrays yield longs in python 2.
+_typecodes = {8:'B', 16:'H', 32:'i'}
+_masks = {8:0xff, 16:0xffff, 32:0xffffffff}
+_swap = sys.byteorder != 'little'
+
+def _align():
+    """ pad (write) or skip (read) to the next 4-byte boundary """
+    global ix_ary
+    if mode == 'w':
+        while len(ary) % 4 != 0:
+            ary.append(0)
+    else:
+        ix_ary = (ix_ary + 3) & ~3
+
+def _encode_ary(lst,n_bits):
+    """ write the elements of "lst" as a block (no count) """
+    lst = [e & _masks[n_bits] for e in lst]
+    if n_bits == 32:
+        # the block is read back signed
+        lst = [e - 0x100000000 if e > 0x7fffffff else e for e in lst]
+    v = array.array(_typecodes[n_bits],lst)
+    if _swap:
+        v.byteswap()
+    _align()
+    ary.fromstring(v.tostring())
+
+def _decode_ary(n,n_bits):
+    """ read a block of "n" elements, returning an array """
+    global ix_ary
+    _align()
+    v = array.array(_typecodes[n_bits])
+    nbytes = n * v.itemsize
+    v.fromstring(buffer(ary,ix_ary,nbytes))
+    if _swap:
+        v.byteswap()
+    ix_ary += nbytes
+    return v
+
+def _encode_count(n):
+    """ write a block count """
+    _encode_ary([n],32)
+
+def _decode_count():
+    """ read a block count """
+    return _decode_ary(1,32)[0]
+
+# Cache format: "ary" is a list of values, read back in order.
+
+def _put(v):
+    """ write a value (cache format) """
+    ary.append(v)
+
+def _get():
+    """ read a value (cache format) """
+    global ix_ary
+    v = ary[ix_ary]
+    ix_ary += 1
+    return v
+
+def encode_index(ht):
+    """
+    encode a mapping derived from other serialized data (a "spelling
+    ->index" dictionary, say). Only the cache format stores it: for
+    the other formats this is a no-op.
+    """
+    if fmt == FMT_CACHE:
+        _put(ht)
+
+def decode_index():
+    """
+    decode a mapping written by "encode_index". Returns None if the
+    format doesn't store it: the caller then rebuilds the mapping.
+    """
+    if fmt == FMT_CACHE:
+        return _get()
+    return None
+
+# int encodings. These are big-endian, and a list of ints is packed
+# or unpacked with a single struct call.
+
+# struct codes for big-endian ints
+_be_codes = {8:'B', 16:'H', 32:'I'}
+
+def encode_ints(lst,n_bits):
+    """ encode the ints in "lst" (no count) """
+    m = _masks[n_bits]
+    ary.fromstring(struct.pack('>%d%s' % (len(lst),_be_codes[n_bits]),
+        *[e & m for e in lst]))
+
+def decode_ints(n,n_bits):
+    """ decode "n" ints: returns a tuple """
+    global ix_ary
+    v = struct.unpack_from('>%d%s' % (n,_be_codes[n_bits]),ary,ix_ary)
+    ix_ary += n * (n_bits/8)
+    return v
 
 def encode_int(v,n_bits=32):
     """ encode an int """
-    if n_bits==8:
-        ary.append(0xff & v)
-    elif n_bits == 16:
-        ary.append(0xff & (v>>8))
-        ary.append(0xff & v)
-    else:
-        ary.append(0xff & (v>>24))
-        ary.append(0xff & (v>>16))
-        ary.append(0xff & (v>>8))
-        ary.append(0xff & v)
+    if fmt == FMT_CACHE:
+        _put(v & _masks[n_bits])
+        return
+    encode_ints((v,),n_bits)
 
 def decode_int(n_bits=32):
     """ decode an int """
-    global ary,ix_ary
-    if n_bits==8:
-        v =  ary[ix_ary]
-        ix_ary += 1
-    elif n_bits == 16:
-        v = (ary[ix_ary] << 8) |\
-            ary[ix_ary+1]
-        ix_ary += 2
-    else:
-        v = (ary[ix_ary] << 24) |\
-            (ary[ix_ary+1] << 16) |\
-            (ary[ix_ary+2] << 8) |\
-            ary[ix_ary+3]
-        ix_ary += 4
-    return v
+    if fmt == FMT_CACHE:
+        return _get()
+    return decode_ints(1,n_bits)[0]
 # string encodings
 
 def encode_str(s):
     """ encode a string """
     global ary
+    if fmt == FMT_CACHE:
+        _put(s)
+        return
     ary.append(len(s))
-    for i in range(0,len(s)):
-        ary.append(ord(s[i]))
+    ary.fromstring(s)
 
 def decode_str():
     """ decode a string """
     global ary,ix_ary
+    if fmt == FMT_CACHE:
+        return _get()
+    if fmt == FMT_V2:
+        slen = ord(ary[ix_ary])
+        ix_ary += 1
+        s = ary[ix_ary : ix_ary+slen]
+        ix_ary += slen
+        return s
     slen = ary[ix_ary]
     ix_ary += 1
     s = ary[ix_ary : ix_ary+slen].tostring()
@@ -112,42 +334,89 @@ def decode_str():
 def encode_strlst(lst):
     """ encode a list of str's """
     global ary
+    if fmt == FMT_CACHE:
+        _put(list(lst))
+        return
+    if fmt == FMT_V2:
+        # offsets, then the concatenated spellings
+        offsets = [0]
+        for sp in lst:
+            offsets.append(offsets[-1] + len(sp))
+        _encode_count(len(lst))
+        _encode_ary(offsets,32)
+        ary.fromstring(''.join(lst))
+        return
     encode_int(len(lst))
-    for s in lst:
-        ary.append(len(s))
-        for i in range(0,len(s)):
-            ary.append(ord(s[i]))
+    ary.fromstring(''.join([chr(len(s)) + s for s in lst]))
 
 def decode_strlst():
     """ decode a list of str's """
     global ary,ix_ary
+    if fmt == FMT_CACHE:
+        return _get()
+    if fmt == FMT_V2:
+        blob,offsets = decode_strlst_blob()
+        return [blob[offsets[i]:offsets[i+1]] \
+            for i in xrange(len(offsets)-1)]
     lst = []
     N = decode_int()
-    for j in range(0,N):
-        slen = ary[ix_ary]
-        ix_ary += 1
-        lst.append(ary[ix_ary : ix_ary+slen].tostring())
-        ix_ary += slen
+    # strings are length-prefixed, so we walk them, but slice each
+    # one out of "ary" in a single step.
+    _ary = ary
+    ix = ix_ary
+    for j in xrange(N):
+        slen = _ary[ix]
+        lst.append(_ary[ix+1 : ix+1+slen].tostring())
+        ix += slen + 1
+    ix_ary = ix
     return lst
 
+def decode_strlst_blob():
+    """
+    decode a list of str's, returning the concatenated strings and
+    an array of offsets: str "i" is blob[offsets[i]:offsets[i+1]].
+    Version 2 only.
+    """
+    global ix_ary
+    N = _decode_count()
+    offsets = _decode_ary(N+1,32)
+    blob = ary[ix_ary : ix_ary+offsets[N]]
+    ix_ary += offsets[N]
+    return (blob,offsets)
+
 # List encodings
 
 def encode_intlst(lst,n_bits):
     """ encode a list of int's """
+    if fmt == FMT_CACHE:
+        _put([e & _masks[n_bits] for e in lst])
+        return
+    if fmt == FMT_V2:
+        _encode_count(len(lst))
+        _encode_ary(lst,n_bits)
+        return
     encode_int(len(lst),16)
-    for e in lst:
-        encode_int(e,n_bits)
+    encode_ints(lst,n_bits)
 
 def decode_intlst(n_bits):
-    """ decode a lits of int's """
-    lst = []
-    N = decode_int(16)
-    for cnt in range(0,N):
-        lst.append(decode_int(n_bits))
-    return lst
+    """
+    decode a list of int's. Version 2 returns an array (not a list).
+    """
+    if fmt == FMT_CACHE:
+        return _get()
+    if fmt == FMT_V2:
+        return _decode_ary(_decode_count(),n_bits)
+    return list(decode_ints(decode_int(16),n_bits))
 
 def encode_lstlst(lst,n_bits):
     """ encode a list of int-list's. """
+    if fmt == FMT_CACHE:
+        # as read back from the other formats: empty rows are None
+        _put([list(v) if v else None for v in lst] if lst else None)
+        return
+    if fmt == FMT_V2:
+        _encode_lstlst2(lst,n_bits)
+        return
     if lst == None:
         encode_int(0,16)
         return
@@ -156,14 +425,17 @@ def encode_lstlst(lst,n_bits):
         len_v = 0 if v is None else len(v)
         encode_int(len_v,16)
         if v is not None:
-            for e in v:
-                encode_int(e,n_bits)
+            encode_ints(v,n_bits)
 
 def decode_lstlst(n_bits):
     """
     decode a list of int-list's. An empty int-list is decoded as
     "None" (not as an empty list).
     """
+    if fmt == FMT_CACHE:
+        return _get()
+    if fmt == FMT_V2:
+        return _decode_lstlst2(n_bits,list)
     lstlst = []
     N = decode_int(16)
     if N == 0:
@@ -173,14 +445,17 @@ def decode_lstlst(n_bits):
         if len_v == 0:
             lstlst.append(None)
             continue
-        v = []
-        for j in range(len_v):
-            v.append(decode_int(n_bits))
-        lstlst.append(v)
+        lstlst.append(list(decode_ints(len_v,n_bits)))
     return lstlst
 
 def encode_lstset(lst,n_bits):
     """ encode a list of sets. """
+    if fmt == FMT_CACHE:
+        _put([set(v) if v else None for v in lst] if lst else None)
+        return
+    if fmt == FMT_V2:
+        _encode_lstlst2(lst,n_bits)
+        return
     if lst == None:
         encode_int(0,16)
         return
@@ -189,14 +464,17 @@ def encode_lstset(lst,n_bits):
         len_v = 0 if v is None else len(v)
         encode_int(len_v,16)
         if v is not None:
-            for e in v:
-                encode_int(e,n_bits)
+            encode_ints(v,n_bits)
 
 def decode_lstset(n_bits):
     """
     decode a list of sets. An empty set-list is decoded as
     "None" (not as an empty list).
     """
+    if fmt == FMT_CACHE:
+        return _get()
+    if fmt == FMT_V2:
+        return _decode_lstlst2(n_bits,set)
     lstset = []
     N = decode_int(16)
     if N == 0:
@@ -206,20 +484,66 @@ def decode_lstset(n_bits):
         if len_v == 0:
             lstset.append(None)
             continue
-        v = set()
-        for j in range(len_v):
-            v.add(decode_int(n_bits))
-        lstset.append(v)
+        lstset.append(set(decode_ints(len_v,n_bits)))
     return lstset
 
+def _encode_lstlst2(lst,n_bits):
+    """
+    version 2 encoding for a list of int-lists (or sets): a count,
+    the row offsets, then the concatenated rows.
+    """
+    if lst is None:
+        _encode_count(0)
+        return
+    offsets = [0]
+    flat = []
+    for v in lst:
+        if v is not None:
+            flat.extend(v)
+        offsets.append(len(flat))
+    _encode_count(len(lst))
+    _encode_ary(offsets,32)
+    _encode_ary(flat,n_bits)
+
+def _decode_lstlst2(n_bits,rowtype):
+    """
+    version 2 decoding for a list of int-lists (or sets). "rowtype"
+    is list or set. As in version 1, an empty row is decoded as None,
+    and an empty list of rows is decoded as None.
+    """
+    N = _decode_count()
+    if N == 0:
+        return None
+    offsets = _decode_ary(N+1,32)
+    flat = _decode_ary(offsets[N],n_bits)
+    rows = []
+    for i in xrange(N):
+        S = offsets[i]
+        E = offsets[i+1]
+        rows.append(rowtype(flat[S:E]) if E > S else None)
+    return rows
+
 # Mapping, str->16-bit int. This is implemented as a hashtable.
 def encode_str_to_int(ht):
+    if fmt == FMT_CACHE:
+        _put(dict(ht))
+        return
+    if fmt == FMT_V2:
+        keys = ht.keys()
+        encode_strlst(keys)
+        encode_intlst([ht[key] for key in keys],16)
+        return
     encode_int(len(ht))
     for key,v in ht.iteritems():
         encode_str(key)
         encode_int(v,16)
         
 def decode_str_to_int():    
+    if fmt == FMT_CACHE:
+        return _get()
+    if fmt == FMT_V2:
+        keys = decode_strlst()
+        return dict(zip(keys,decode_intlst(16)))
     N = decode_int()
     ht = {}
     for i in range(0,N):
@@ -227,6 +551,16 @@ def decode_str_to_int():
         ht[key] = decode_int(16)
     return ht
     
+def compact_intlst(lst):
+    """
+    Convert a decoded list of int's to an array (version 2 reads
+    already return arrays). An array holds its elements as raw
+    machine ints, rather than as int objects.
+    """
+    if isinstance(lst,array.array):
+        return lst
+    return array.array('l',lst)
+
 # Probability tables. These are implemented as dictionaries:
 # mapping str->log(probabilty), where "prob" runs from 0..1.0
 
@@ -259,25 +593,59 @@ def decode_log_prob_tbl():
         tbl[key] = decode_log_prob()
     return tbl
 
-if __name__== '__main__':
+def _ut_fmt(_fmt):
+    """ write and read back some data in the given format """
     i = 123
     intlst = [1,2]
     strlst = ['a','ab']
-    lstlst = [[1,2],[3]]
-    init('x.dat','w')
+    lstlst = [[1,2],None,[3]]
+    lstset = [set([1,2]),set([3])]
+    ht = {'a':1,'b c':2}
+    init('x.dat','w',_fmt)
     encode_int(i)
+    encode_str('abc')
     encode_intlst(intlst,32)
     encode_strlst(strlst)
     encode_lstlst(lstlst,16)
+    encode_lstset(lstset,8)
+    begin_section('tail')
+    encode_str_to_int(ht)
+    encode_intlst(intlst,8)
+    encode_index(ht)
     fini()
     init('x.dat','r')
+    assert fmt == _fmt
+    if fmt == FMT_V2:
+        # read the tail section first
+        begin_section('tail')
+        assert decode_str_to_int() == ht
+        fini()
+        init('x.dat','r')
     i2 = decode_int()
+    str2 = decode_str()
     intlst2 = decode_intlst(32)
     strlst2 = decode_strlst()
     lstlst2 = decode_lstlst(16)
+    lstset2 = decode_lstset(8)
+    begin_section('tail')
+    ht2 = decode_str_to_int()
+    intlst3 = decode_intlst(8)
+    ht3 = decode_index()
     fini()
     assert i == i2
-    assert intlst == intlst2
+    assert str2 == 'abc'
+    assert list(intlst) == list(intlst2)
     assert strlst == strlst2
     assert lstlst == lstlst2
+    assert lstset == lstset2
+    assert ht == ht2
+    assert list(intlst) == list(intlst3)
+    # only the cache stores derived mappings
+    assert ht3 == (ht if fmt == FMT_CACHE else None)
 
+if __name__== '__main__':
+    _ut_fmt(FMT_V1)
+    _ut_fmt(FMT_V2)
+    _ut_fmt(FMT_CACHE)
+    os.remove(get_filepath('x.dat'))
+    print "pass unit test"
@@ -12,29 +12,132 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import mmap
+import marshal
+import os
+import io
+import gzip
+import bz2
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # no support for xz files
+        lzma = None
+
+# If True, "open_file" memory-maps the file.
+use_mmap = True
+# Compressed files are recognized by their magic bytes.
+gz_magic = '\x1f\x8b'
+bz2_magic = 'BZh'
+xz_magic = '\xfd7zXZ\x00'
+# buffer size for reads of compressed files
+compressed_buf_size = 1 << 20
+
+def open_compressed(fn,magic):
+    """
+    Open compressed file "fn", given the bytes at the start of the
+    file: returns a file object that reads the decompressed text, or
+    None if the file isn't compressed.
+    """
+    if magic.startswith(gz_magic):
+        return io.BufferedReader(gzip.GzipFile(fn,'rb'),
+            compressed_buf_size)
+    if magic.startswith(bz2_magic):
+        return bz2.BZ2File(fn,'r',compressed_buf_size)
+    if magic.startswith(xz_magic):
+        if lzma is None:
+            raise IOError('%s: xz compressed, and there is no lzma module'
+                % fn)
+        return io.BufferedReader(lzma.LZMAFile(fn,'rb'),
+            compressed_buf_size)
+    return None
+
+def open_file(fn):
+    """
+    Open file "fn" for reading by a Source. A compressed file (gzip,
+    bzip2 or xz) is decompressed as it's read: offsets in the source
+    are then offsets into the decompressed text. If "use_mmap" is
+    True, we memory-map an uncompressed file and return the map.
+    Otherwise (or if the file can't be mapped: an empty file, say) we
+    return the open file. Either way, the caller closes it.
+    """
+    fp = open(fn,"r")
+    magic = fp.read(len(xz_magic))
+    fp.seek(0)
+    fp_dc = open_compressed(fn,magic)
+    if fp_dc is not None:
+        fp.close()
+        return fp_dc
+    if use_mmap:
+        try:
+            m = mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ)
+            fp.close()
+            return m
+        except (ValueError,EnvironmentError):
+            pass
+    return fp
+
+def write_checkpoint(fn,src,n_sect):
+    """
+    Write a checkpoint for Source "src" to file "fn": the source's
+    state between sections (see "Source.get_state"), and the number
+    of sections parsed so far. We write a temp file and rename it, so
+    a crash while writing leaves the previous checkpoint intact.
+    """
+    state = src.get_state()
+    state['n_sect'] = n_sect
+    fn_tmp = fn + '.tmp'
+    fp = open(fn_tmp,'wb')
+    fp.write(marshal.dumps(state))
+    fp.close()
+    if os.path.exists(fn):
+        # (on Windows, rename won't replace a file)
+        os.remove(fn)
+    os.rename(fn_tmp,fn)
+
+def read_checkpoint(fn):
+    """ read a checkpoint written by "write_checkpoint": a dict """
+    fp = open(fn,'rb')
+    state = marshal.loads(fp.read())
+    fp.close()
+    return state
+
 class Source:
     """
     This class encapuslates access to the text to be parsed: 
     either contents of a file, or a string representation of the text.
+    A file may be given as an open file, or as a memory map of it (see
+    "open_file"). For a map, we find the lines with "mmap.find", rather
+    than reading them through a file object.
     """
     def __init__(self,content_provider):
 	# "contentProvider" can be either a file or a string
         self.fp = None
         self.string = None
+        self.map = None
         if isinstance(content_provider,str):
             self.string = content_provider
+        elif isinstance(content_provider,mmap.mmap):
+            self.map = content_provider
         else:
             self.fp = content_provider
+        # offset in the source of the next line
         self.ix = 0
         self.eofsrc = False
-        # line number and indent for current line
+        # line number, indent, and offset in the source for current
+        # line. For a file, offsets are byte offsets.
         self.lno = 0
         self.indent = 0
+        self.offset = 0
         # text for current section
         self.sect_text = None
-        # line number and indent for current sect
+        # line number, indent and offset for current sect
         self.sect_lno = 0
         self.sect_indent = 0
+        self.sect_offset = 0
         # number of blank lines preceding the section
         self.sect_blank = 0
         # look-ahead line. This line belongs to the
@@ -42,6 +145,38 @@ class Source:
         self.peek_li = None
         self.peek_li_lno = 0
         self.peek_li_indent = 0
+        self.peek_li_offset = 0
+
+    def get_state(self):
+        """
+        Get the state of the source between sections (after a call to
+        "get_section"): a dict, giving the offset of the next line to
+        read, the line number of the last line read, and the
+        look-ahead line. See "set_state".
+        """
+        return {'ix':self.ix,
+            'lno':self.lno,
+            'eofsrc':self.eofsrc,
+            'peek_li':self.peek_li,
+            'peek_li_lno':self.peek_li_lno,
+            'peek_li_indent':self.peek_li_indent,
+            'peek_li_offset':self.peek_li_offset}
+
+    def set_state(self,state):
+        """
+        Restore a state obtained from "get_state" (for a file, we seek
+        to the recorded offset): the next call to "get_section" gets
+        the section that followed when the state was recorded.
+        """
+        self.ix = state['ix']
+        if self.fp is not None:
+            self.fp.seek(self.ix)
+        self.lno = state['lno']
+        self.eofsrc = state['eofsrc']
+        self.peek_li = state['peek_li']
+        self.peek_li_lno = state['peek_li_lno']
+        self.peek_li_indent = state['peek_li_indent']
+        self.peek_li_offset = state['peek_li_offset']
 
     def getline(self):
         """
@@ -51,29 +186,36 @@ class Source:
         """
         if self.eofsrc:
             return None
+        self.offset = self.ix
         if self.fp is not None:
             li = self.fp.readline();
             if len(li) == 0:
                 self.eofsrc = True
                 return None
+            self.ix += len(li)
+        elif self.map is not None:
+            # same lines as "readline" on the file
+            if self.ix >= len(self.map):
+                self.eofsrc = True
+                return None
+            E = self.map.find('\n',self.ix)
+            if E == -1:
+                E = len(self.map)
+            li = self.map[self.ix:E]
+            self.ix = E + 1
         else:
-            S = E = self.ix
-            while E<len(self.string) and self.string[E] != '\n':
-                E += 1
-            li = self.string[S:E]
+            E = self.string.find('\n',self.ix)
+            if E == -1:
+                E = len(self.string)
+            li = self.string[self.ix:E]
             # the newline is considered part of this line
             self.ix = E + 1
             if self.ix >= len(self.string):
                 self.eofsrc = True
         self.lno += 1
-        self.indent = 0
-        for c in li:
-            if c == ' ':
-                self.indent += 1
-            elif c == '\t':
-                self.indent += 4
-            else:
-                break
+        # indent: a space counts 1, a tab counts 4.
+        n_lead = len(li) - len(li.lstrip(' \t'))
+        self.indent = n_lead + 3*li.count('\t',0,n_lead)
         return li.strip()
 
     def get_section(self):
@@ -90,16 +232,20 @@ class Source:
                 return False
             self.sect_lno = self.lno
             self.sect_indent = self.indent
+            self.sect_offset = self.offset
         else:
             li = self.peek_li
+            self.peek_li = None
             self.sect_lno = self.peek_li_lno
             self.sect_indent = self.peek_li_indent
+            self.sect_offset = self.peek_li_offset
         # skip over initial blank lines (but keep count)
         self.sect_blank = 0
         while li is not None and len(li) == 0:
             li = self.getline()
             self.sect_lno = self.lno
             self.sect_indent = self.indent
+            self.sect_offset = self.offset
             self.sect_blank += 1
         if li is None:
             # source has been exhausted
@@ -117,6 +263,7 @@ class Source:
                 self.peek_li = li
                 self.peek_li_lno = self.lno
                 self.peek_li_indent = self.indent
+                self.peek_li_offset = self.offset
                 break
             # this line is part of the current section
             sect.append(li.strip())
@@ -143,12 +290,33 @@ Para3, line3.
     # string version
     src = Source(txt)
     tmp = []
+    states = []
     while src.get_section():
         desc = 'blank:%d lno:%d indent:%d txt:\n%s\n' % \
             (src.sect_blank,src.sect_lno,
              src.sect_indent,src.sect_text)
         tmp.append(desc)
+        states.append(src.get_state())
     version1 = '\n'.join(tmp)
+    # resume after each section: we should get the sections that
+    # followed.
+    for i in range(len(states)):
+        src = Source(txt)
+        src.set_state(states[i])
+        n = 0
+        while src.get_section():
+            n += 1
+            assert src.sect_text in tmp[i+n]
+        assert i+1+n == len(tmp)
+    # When the last section starts with a look-ahead line (an indented
+    # line, or one after a blank line), the look-ahead must be used
+    # just once: this once returned that section forever.
+    for t in ('a\n  b','a\n  b\n','a\n\nb'):
+        src = Source(t)
+        sects = []
+        while len(sects) < 5 and src.get_section():
+            sects.append(src.sect_text)
+        assert sects == ['a','b'], sects
     print version1
     # file version
     fp = open("ut.txt","w")
@@ -163,7 +331,22 @@ Para3, line3.
              src.sect_indent,src.sect_text)
         tmp.append(desc)
     version2 = '\n'.join(tmp)
-    if version2 == version2:
+    fp.close()
+    # memory-mapped file version
+    m = open_file("ut.txt")
+    src = Source(m)
+    tmp = []
+    while src.get_section():
+        desc = 'blank:%d lno:%d indent:%d txt:\n%s\n' % \
+            (src.sect_blank,src.sect_lno,
+             src.sect_indent,src.sect_text)
+        tmp.append(desc)
+        # the offset gives the section's first line
+        assert txt[src.sect_offset:].split('\n')[0].strip() == \
+            src.sect_text.split('\n')[0]
+    version3 = '\n'.join(tmp)
+    m.close()
+    if version1 == version2 and version2 == version3:
         print "PASS unit test"
     else:
         print "FAIL unit test"
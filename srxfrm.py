@@ -14,7 +14,6 @@
 
 from defs import *
 import vcb
-from vcb import sc_dct
 import serializer
 import xfrm
 from xfrm import Xfrm
@@ -217,7 +216,7 @@ class SrFSM(FSM):
             if y == 0:
                 # skip: sequence not used in this map
                 continue
-            srseq = self.srmap.ydct.sequences[y]
+            srseq = list(self.srmap.ydct.sequences[y])
             srseq_sp = srseq_tostr(srseq)
             hd = '%s -> %s\n' % (scseq_sp,srseq_sp)
             lst.append(hd + '    %s -> %s\n' % (key,str(srseq)))
@@ -249,6 +248,10 @@ class SrMap:
             self.x_to_y = serializer.decode_intlst(16)
             self.w = serializer.decode_intlst(16)
 
+    def compact(self):
+        self.x_to_y = serializer.compact_intlst(self.x_to_y)
+        self.w = serializer.compact_intlst(self.w)
+
     def get_n(self):
         N = 0
         for w in self.w:
@@ -273,10 +276,10 @@ class SrMap:
         for i in range(0,len(self.w)):
             if self.w[i] == 0:
                 continue
-            seq = self.xdct.sequences[i]
+            seq = list(self.xdct.sequences[i])
             fp.write('x%d. %s %s\n' % \
                 (i,str(seq),vcb.spell_sc(seq)))
-            seq = self.ydct.sequences[self.x_to_y[i]]
+            seq = list(self.ydct.sequences[self.x_to_y[i]])
             fp.write('y%d. %s %s\n' % \
                 (i,str(seq),srseq_tostr(seq)))
             fp.write('Weight: %d\n\n' % self.w[i])
@@ -327,15 +330,28 @@ class SeqDct():
     def serialize(self,mode):
         if mode == 'w':
             serializer.encode_lstlst(self.sequences,16)
+            serializer.encode_index(self.dct)
         else:
             self.sequences = serializer.decode_lstlst(16)
             # serialization decodes empty list as None: fix that
             # for null sequence
             self.sequences[0] = []
+            dct = serializer.decode_index()
+            if dct is not None:
+                self.dct = dct
+                return
             for i in range(1,len(self.sequences)):
                 key = ' '.join([str(e) for e in self.sequences[i]])
                 self.dct[key] = i
 
+    def compact(self):
+        """
+        Convert the sequences to tuples. The garbage collector stops
+        tracking a tuple of ints, so a full collection doesn't touch
+        them (a list is always tracked).
+        """
+        self.sequences = [tuple(seq) for seq in self.sequences]
+
     def get_n(self):
         # return number of sequences. This does NOT include the
         # null (empty) sequence that is always included in the
@@ -357,7 +373,7 @@ class SeqDct():
             fp = sys.stdout
         fp.write('\n--> %s\n' % self.name)
         for i in range(0,len(self.sequences)):
-            seq = self.sequences[i]
+            seq = list(self.sequences[i])
             fp.write('%d. %s %s\n' % (i,str(seq),self.seq_tostr(seq)))
 
     def get_seq(self,i):
@@ -386,6 +402,9 @@ class SrXfrm(Xfrm):
     part-of-speach. In this phase of the parse, we assign an
     "sr" (syntax relation) to each node.
     """
+    # our parse maps are data tables
+    tables = True
+
     def __init__(self,_name=''):
         Xfrm.__init__(self,_name)
         # debug toggles
@@ -410,6 +429,12 @@ class SrXfrm(Xfrm):
             if mode == 'r':
                 p.fsm.seq_to_v = self.xdct.dct
 
+    def compact(self):
+        self.xdct.compact()
+        self.ydct.compact()
+        for p in self.srmap:
+            p.compact()
+
     def printstats(self,fp,title=None):
         if fp is None:
             fp = sys.stdout
@@ -434,7 +459,7 @@ class SrXfrm(Xfrm):
             fp = sys.stdout
         if title is not None:
             fp.write('%s ' % title)
-        seq = self.xdct.sequences[ix]
+        seq = list(self.xdct.sequences[ix])
         fp.write('x%d. %s %s\n' % \
             (ix,str(seq),vcb.spell_sc(seq)))
 
@@ -443,7 +468,7 @@ class SrXfrm(Xfrm):
             fp = sys.stdout
         if title is not None:
             fp.write('%s ' % title)
-        seq = self.ydct.sequences[ix]
+        seq = list(self.ydct.sequences[ix])
         fp.write('y%d. %s %s\n' % \
             (ix,str(seq),srseq_tostr(seq)))
 
@@ -485,7 +510,7 @@ class SrXfrm(Xfrm):
         w *= 0xffff
         tmp = ['w: %.1f' % w]
         for e in path:
-            scseq =  self.xdct.sequences[e.x]
+            scseq =  list(self.xdct.sequences[e.x])
             xtostr = vcb.spell_sc(scseq)
             y = e.srmap.x_to_y[e.x]
             ytostr = srseq_tostr( self.ydct.sequences[y] )
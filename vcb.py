@@ -16,23 +16,37 @@ from defs import *
 import re
 import serializer
 import os
+import zlib
+import array
 
 class Int16PairToInt8():
     """
     Serializable mapping, (int16,int16)->int8. This utility class
     used by the vocabulary to represent the mapping
     (prep,verb)->fitness, where fitness measures the
-    strength of the association.
+    strength of the association. The key for a pair is the int
+    (l1<<16)|l2.
     """
     def __init__(self):
         self.pair_to_v = {}
 
     def lkup(self,l1,l2):
-        v = self.pair_to_v.get('%d %d' % (l1,l2))
-        return -1 if v is None else v
+        if l1 > 0xffff or l2 > 0xffff:
+            # not an int16 pair (an overlay entry): no mapping
+            return -1
+        return self.pair_to_v.get((l1<<16)|l2,-1)
+
+    def lkup_lst(self,l1,l2lst):
+        """ lookup (l1,l2) for each l2 in "l2lst": returns a list """
+        if l1 > 0xffff:
+            return [-1] * len(l2lst)
+        get = self.pair_to_v.get
+        key1 = l1<<16
+        return [get(key1|l2,-1) if l2 <= 0xffff else -1 \
+            for l2 in l2lst]
 
     def add(self,l1,l2,v):
-        self.pair_to_v['%d %d' % (l1,l2)] = v
+        self.pair_to_v[(l1<<16)|l2] = v
 
     def serialize(self,mode):
         if mode == 'w':
@@ -40,22 +54,22 @@ class Int16PairToInt8():
             l2lst = []
             rlst = []
             for key,v in self.pair_to_v.iteritems():
-                l1,l2 = key.split(' ')
-                l1lst.append(int(l1))
-                l2lst.append(int(l2))
+                l1lst.append(key>>16)
+                l2lst.append(key & 0xffff)
                 rlst.append(v)
             serializer.encode_intlst(l1lst,16)
             serializer.encode_intlst(l2lst,16)
             serializer.encode_intlst(rlst,8)
+            serializer.encode_index(self.pair_to_v)
         else:
             l1lst = serializer.decode_intlst(16)
             l2lst = serializer.decode_intlst(16)
             rlst = serializer.decode_intlst(8)
-            self.pair_to_v = {}
-            for i in range(len(l1lst)):
-                l1 = l1lst[i]
-                l2 = l2lst[i]
-                self.pair_to_v['%d %d' % (l1,l2)] = rlst[i]
+            self.pair_to_v = serializer.decode_index()
+            if self.pair_to_v is not None:
+                return
+            self.pair_to_v = dict(zip( \
+                [(l1<<16)|l2 for l1,l2 in zip(l1lst,l2lst)],rlst))
 
 class WordVariant():
     """
@@ -66,6 +80,62 @@ class WordVariant():
     props = 0
     vprops = 0
 
+class Inflections():
+    """
+    Precomputed word variants: mapping, surface form -> (root, props,
+    vprops). This is the result of "is_word_variant" for every form
+    that is a variant of a word in the vocabulary ("looked", "softly",
+    "isn't"), so analysing an unknown word is a single probe. It's
+    created by the make tool ("makevcb.py").
+    """
+    def __init__(self):
+        # form->index
+        self.form_to_ix = {}
+        # index->form
+        self.forms = []
+        # index->(root_key,props,vprops)
+        self.root_key = []
+        self.props = []
+        self.vprops = []
+
+    def add(self,form,v):
+        """ add a form: "v" is a WordVariant """
+        self.form_to_ix[form] = len(self.forms)
+        self.forms.append(form)
+        self.root_key.append(v.root_key)
+        self.props.append(v.props)
+        self.vprops.append(v.vprops)
+
+    def lkup(self,wrd,v):
+        """
+        is "wrd" a variant? If so, we fill in the WordVariant "v" and
+        return True.
+        """
+        ix = self.form_to_ix.get(wrd)
+        if ix is None:
+            return False
+        v.root_key = self.root_key[ix]
+        v.props = self.props[ix]
+        v.vprops = self.vprops[ix]
+        return True
+
+    def serialize(self,mode):
+        if mode == 'w':
+            serializer.encode_strlst(self.forms)
+            serializer.encode_index(self.form_to_ix)
+            serializer.encode_intlst(self.root_key,32)
+            serializer.encode_intlst(self.props,32)
+            serializer.encode_intlst(self.vprops,32)
+        else:
+            self.forms = serializer.decode_strlst()
+            self.form_to_ix = serializer.decode_index()
+            if self.form_to_ix is None:
+                self.form_to_ix = dict(zip(self.forms,
+                    xrange(len(self.forms))))
+            self.root_key = serializer.decode_intlst(32)
+            self.props = serializer.decode_intlst(32)
+            self.vprops = serializer.decode_intlst(32)
+
 class RewriteRules():
     """
     A rewrite rule specifies a lhs ("target"), and a rhs
@@ -84,6 +154,37 @@ class RewriteRules():
         # index for a word. "ruleIx" is the index of a rewrite rule,
         # such that the lhs of the rules starts with that word.
         self.index = []
+        # The lhs's, compiled into a trie (see "compile"). None means
+        # we haven't compiled the current rules.
+        self.trie = None
+
+    def compile(self):
+        """
+        Compile the rules into a trie over token sequences. A node is
+        a list [children,pos,rix]: "children" maps a (definition) token
+        to the child node; "rix" is the rule whose lhs ends at this
+        node (None if there's none), and "pos" is its position in the
+        index list for the lhs's first word. Where several rules
+        match, the rule that comes first in that list applies (the
+        list is ordered longest lhs first), so a lookup only has to
+        walk the trie once.
+        """
+        root = [{},None,None]
+        for rules in self.index:
+            if rules is None:
+                continue
+            for pos in range(0,len(rules)):
+                rix = rules[pos]
+                node = root
+                for tok in self.lhs[rix]:
+                    child = node[0].get(tok)
+                    if child is None:
+                        child = node[0][tok] = [{},None,None]
+                    node = child
+                if node[2] is None:
+                    node[1] = pos
+                    node[2] = rix
+        self.trie = root
 
     def serialize(self,mode):
         if mode == 'w':
@@ -94,6 +195,261 @@ class RewriteRules():
             self.lhs = serializer.decode_lstlst(16)
             self.rhs = serializer.decode_lstlst(16)
             self.index = serializer.decode_lstlst(16)
+            self.compile()
+
+class Overlay():
+    """
+    Entries for words that aren't in the base vocabulary. The base
+    vocabulary (entries 0..n_base-1, read from "msp.dat") is not
+    changed by a parse: when the lexer meets an unknown word (or a
+    multi-word proper name, such as "John F. Kennedy"), we add an
+    entry above n_base. If "max_n" is None, the overlay is dropped at
+    the start of each parse. Otherwise it's kept between parses, but
+    bounded: we evict least recently used entries, to keep it to
+    "max_n" entries.
+    """
+    def __init__(self):
+        self.n_base = 0
+        self.max_n = None
+        # serial number for the current parse
+        self.n_parse = 0
+        # LRU mode: entry -> serial number of the last parse that
+        # used it
+        self.last_used = {}
+        # LRU mode: indices of evicted entries, available for reuse
+        self.free = []
+        # metrics
+        self.n_added = 0
+        self.n_evicted = 0
+        self.n_reset = 0
+
+class ExpansionCache():
+    """
+    Cache for the lexer: surface string -> expansion. Contractions
+    ("don't", "we'll") and abbreviation probes ("Mr.") repeat
+    constantly, so the lexer caches the result of analysing them (see
+    "lexer.append_contract"). An entry records the tokens it depends
+    on: if any are overlay entries, the entry is dropped when the
+    overlay is reset or trimmed. An entry may also depend on a
+    spelling *not* being in the vocabulary: it's "watched", and
+    dropped if an entry is created for the spelling. The cache is
+    bounded to "max_n" entries: when it's full, we clear it.
+    """
+    def __init__(self):
+        self.max_n = 4096
+        # key -> (value,overlay tokens the value depends on)
+        self.map = {}
+        # keys for entries that depend on overlay entries
+        self.volatile = set()
+        # spelling -> keys for entries that need it to be undefined
+        self.watch = {}
+        # metrics
+        self.n_hit = 0
+        self.n_miss = 0
+        self.n_clear = 0
+
+    def get(self,key):
+        """ get the value for "key": None if we don't have it """
+        e = self.map.get(key)
+        if e is None:
+            self.n_miss += 1
+            return None
+        self.n_hit += 1
+        if e[1] and overlay.max_n is not None:
+            # the lookups we skip would mark these entries as used
+            for ix in e[1]:
+                overlay.last_used[ix] = overlay.n_parse
+        return e[0]
+
+    def put(self,key,value,toks,absent=None):
+        """
+        Add an entry. "toks" are the tokens "value" depends on, and
+        "absent" (if not None) is a spelling that must not be defined.
+        """
+        if absent is not None and dct.lkup(absent,False) != 0:
+            # analysing the key defined the spelling
+            return
+        if len(self.map) >= self.max_n:
+            self.clear()
+        n_base = overlay.n_base
+        ovl = tuple([ix for ix in toks if ix >= n_base])
+        self.map[key] = (value,ovl)
+        if ovl:
+            self.volatile.add(key)
+        if absent is not None:
+            self.watch.setdefault(absent,set()).add(key)
+
+    def drop(self,keys):
+        """ drop entries """
+        for key in keys:
+            if key in self.map:
+                del self.map[key]
+            self.volatile.discard(key)
+
+    def drop_overlay(self):
+        """ drop entries that depend on overlay entries """
+        volatile = self.volatile
+        self.volatile = set()
+        self.drop(volatile)
+
+    def clear(self):
+        """ drop all entries """
+        self.map = {}
+        self.volatile = set()
+        self.watch = {}
+        self.n_clear += 1
+
+def sp_hash(sp):
+    """ hash "sp": returns a pair of (independent) 32 bit hashes """
+    return (zlib.crc32(sp) & 0xffffffff, zlib.adler32(sp) & 0xffffffff)
+
+class SpellingIndex():
+    """
+    Minimal perfect hash over the base vocabulary: spelling->index.
+    This holds the spellings too, concatenated in a single string
+    ("blob") with an offsets array, and serves as the dictionary's
+    spelling list: entries added at runtime go in "extra". The hash
+    is created by the make tool ("makevcb.py") and stored in msp.dat
+    (section "spindex"); the spellings come from the dictionary's own
+    spelling list.
+
+    A word hashes to (h1,h2), and goes in bucket (h1*n_buckets)>>32.
+    Each bucket has a seed, chosen when the index is built so that
+    every word in the bucket gets a slot no other word uses. The seed
+    is a pair (d0,d1), held as d0*n_keys + d1, and the slot for a
+    word is (h1 + d0*h2 + d1) % n_keys. "slots" maps slot->index.
+    """
+    def __init__(self):
+        # number of base entries
+        self.n = 0
+        # bucket->seed
+        self.seeds = []
+        # slot->index
+        self.slots = []
+        # spelling "i" is blob[offsets[i]:offsets[i+1]]
+        self.blob = ''
+        self.offsets = [0]
+        # spellings for entries added at runtime
+        self.extra = []
+
+    def build(self,spelling):
+        """ build the index for a spelling list """
+        self.n = len(spelling)
+        self.blob = ''.join(spelling)
+        self.offsets = array.array('l',[0])
+        for sp in spelling:
+            self.offsets.append(self.offsets[-1] + len(sp))
+        # spelling->index, as the dictionary has it: if a spelling
+        # appears twice, its last index wins.
+        ht = {}
+        for i in xrange(self.n):
+            ht[spelling[i]] = i
+        n_keys = len(ht)
+        n_buckets = max(1,n_keys/4)
+        buckets = [[] for b in xrange(n_buckets)]
+        for sp,ix in ht.iteritems():
+            h1,h2 = sp_hash(sp)
+            buckets[(h1*n_buckets) >> 32].append((h1,h2,ix))
+        # place the largest buckets first
+        order = range(n_buckets)
+        order.sort(key=lambda b: -len(buckets[b]))
+        slots = [-1]*n_keys
+        seeds = [0]*n_buckets
+        free_ix = 0
+        for b in order:
+            if len(buckets[b]) == 0:
+                break
+            if len(buckets[b]) == 1:
+                # any free slot will do: d0 is 0, and d1 takes us
+                # there.
+                while slots[free_ix] != -1:
+                    free_ix += 1
+                h1,h2,ix = buckets[b][0]
+                seeds[b] = (free_ix - h1) % n_keys
+                slots[free_ix] = ix
+                continue
+            seed = 0
+            while True:
+                taken = []
+                d0,d1 = divmod(seed,n_keys)
+                for h1,h2,ix in buckets[b]:
+                    s = (h1 + d0*h2 + d1) % n_keys
+                    if slots[s] != -1 or s in taken:
+                        break
+                    taken.append(s)
+                if len(taken) == len(buckets[b]):
+                    break
+                seed += 1
+            seeds[b] = seed
+            for i in range(len(taken)):
+                slots[taken[i]] = buckets[b][i][2]
+        self.seeds = array.array('l',seeds)
+        self.slots = array.array('l',slots)
+
+    def lkup(self,sp):
+        """
+        lookup "sp" in the base vocabulary, returning its index (None
+        if it's not there)
+        """
+        n_keys = len(self.slots)
+        if n_keys == 0:
+            return None
+        h1 = zlib.crc32(sp) & 0xffffffff
+        seed = self.seeds[(h1*len(self.seeds)) >> 32]
+        if seed < n_keys:
+            s = (h1 + seed) % n_keys
+        else:
+            d0,d1 = divmod(seed,n_keys)
+            s = (h1 + d0*(zlib.adler32(sp) & 0xffffffff) + d1) % n_keys
+        ix = self.slots[s]
+        offsets = self.offsets
+        S = offsets[ix]
+        if offsets[ix+1] - S == len(sp) and self.blob.startswith(sp,S):
+            return ix
+        return None
+
+    def serialize(self,mode):
+        """
+        read/write the hash. On reads, the caller supplies the
+        spellings (see "Dict.serialize").
+        """
+        if mode == 'w':
+            serializer.encode_intlst(self.seeds,32)
+            serializer.encode_intlst(self.slots,32)
+        else:
+            self.seeds = serializer.decode_intlst(32)
+            self.slots = serializer.decode_intlst(32)
+
+    # The index serves as a spelling list: these methods support the
+    # list operations the vocabulary uses.
+
+    def __len__(self):
+        return self.n + len(self.extra)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self,ix):
+        if isinstance(ix,slice):
+            return [self[i] for i in xrange(*ix.indices(len(self)))]
+        if ix < 0:
+            ix += len(self)
+        if ix < self.n:
+            return self.blob[self.offsets[ix]:self.offsets[ix+1]]
+        return self.extra[ix-self.n]
+
+    def __setitem__(self,ix,sp):
+        # only entries added at runtime can be changed
+        self.extra[ix-self.n] = sp
+
+    def __delitem__(self,ix):
+        # only entries added at runtime can be deleted: "ix" is a
+        # slice, "ix.start..".
+        del self.extra[ix.start-self.n:]
+
+    def append(self,sp):
+        self.extra.append(sp)
 
 class Dict():
     """
@@ -108,6 +464,10 @@ class Dict():
         self.spelling = []
         # index->props
         self.props = []
+        # spelling index for the base entries, or None. If we read
+        # the dictionary through the index, "spelling" is the index,
+        # and "sp_to_ix" only holds the entries added at runtime.
+        self.index = None
 
     def get_n(self):
         # get number of entries
@@ -118,6 +478,10 @@ class Dict():
         ix = self.sp_to_ix.get(sp)
         if ix != None:
             return ix
+        if self.index is not None:
+            ix = self.index.lkup(sp)
+            if ix != None:
+                return ix
         if not create_if_missing:
             return 0
         ix = len(self.spelling)
@@ -126,17 +490,47 @@ class Dict():
         self.props.append(0);
         return ix
 
-    def serialize(self,mode):
-        """ serialize  the dictionary """
+    def get_sp_to_ix(self):
+        """ get the mapping spelling->index, as a dict """
+        if self.spelling is not self.index:
+            return self.sp_to_ix
+        ht = dict(zip(self.index[0:self.index.n],xrange(self.index.n)))
+        ht.update(self.sp_to_ix)
+        return ht
+
+    def serialize(self,mode,index_section=None):
+        """
+        serialize  the dictionary. On reads, "index_section" names the
+        section holding the spelling index: if it's given, and the
+        file has it, we use the index rather than building
+        "sp_to_ix".
+        """
         global sp_to_ix,spelling,props
         if mode == 'w':
             serializer.encode_strlst(self.spelling)
+            serializer.encode_index(self.get_sp_to_ix())
             serializer.encode_intlst(self.props,32)
+        elif index_section is not None and \
+            serializer.has_section(index_section):
+            self.index = SpellingIndex()
+            self.index.blob,self.index.offsets = \
+                serializer.decode_strlst_blob()
+            self.index.n = len(self.index.offsets) - 1
+            # the hash is in a section of its own
+            state = serializer.get_state()
+            serializer.begin_section(index_section)
+            self.index.serialize(mode)
+            serializer.set_state(state)
+            self.spelling = self.index
+            self.sp_to_ix = {}
+            self.props = serializer.decode_intlst(32)
         else:
             self.spelling = serializer.decode_strlst()
-            self.sp_to_ix = {}
-            for i in range(len(self.spelling)):
-                self.sp_to_ix[self.spelling[i]] = i
+            self.sp_to_ix = serializer.decode_index()
+            if self.sp_to_ix is None:
+                self.sp_to_ix = {}
+                for i in range(len(self.spelling)):
+                    self.sp_to_ix[self.spelling[i]] = i
             self.props = serializer.decode_intlst(32)
 
     def spell(self,ix_or_lst):
@@ -199,11 +593,76 @@ sc_dct = Dict()
 sc_singletons = []
 # version info: readin from "lexicon.txt"
 version = "?"
+# entries for unknown words
+overlay = Overlay()
+# lexer cache: expansions for contractions and abbreviations
+expansions = ExpansionCache()
+# precomputed word variants. None means we don't have the table (the
+# file predates it): we then analyse unknown words as we meet them.
+inflections = None
+# names of the module attributes that hold the vocabulary tables. See
+# "get_tables" and "set_tables".
+table_names = ['dct','vprops','_def','synclass','rwrules',
+    'prep_verb_fitness','sc_dct','sc_singletons','version','overlay',
+    'inflections','expansions']
+
+def new_tables():
+    """
+    install new (empty) vocabulary tables: "serialize('r')" can then
+    read a vocabulary without touching the current one.
+    """
+    global dct,vprops,_def,synclass,rwrules,prep_verb_fitness
+    global sc_dct,sc_singletons,version,overlay,inflections,expansions
+    dct = Dict()
+    vprops = []
+    _def = []
+    synclass = []
+    rwrules = RewriteRules()
+    prep_verb_fitness = Int16PairToInt8()
+    sc_dct = Dict()
+    sc_singletons = []
+    version = "?"
+    overlay = Overlay()
+    inflections = None
+    expansions = ExpansionCache()
+
+def compact():
+    """
+    Convert the int tables to arrays (see "parser.compact_tables").
+    The tables can still grow: an array supports "append".
+    """
+    global vprops,_def,synclass
+    vprops = serializer.compact_intlst(vprops)
+    _def = serializer.compact_intlst(_def)
+    synclass = serializer.compact_intlst(synclass)
+    dct.props = serializer.compact_intlst(dct.props)
+    sc_dct.props = serializer.compact_intlst(sc_dct.props)
+
+def get_tables():
+    """ get the vocabulary tables: a dict, attribute name->value """
+    g = globals()
+    return dict([(name,g[name]) for name in table_names])
+
+def set_tables(tables):
+    """ install vocabulary tables obtained from "get_tables" """
+    globals().update(tables)
 
-def serialize(mode):
+def serialize(mode,sp_index=False):
+    """
+    read/write the vocabulary. If "sp_index" is True (read mode), the
+    dictionary's spelling->index mapping is taken from the spelling
+    index stored in msp.dat (see "SpellingIndex"), rather than built
+    as a dict. This saves memory (the tables hold no str objects for
+    the base vocabulary), at some cost in lookup time. The startup
+    cache holds the plain tables, so this applies to reads of msp.dat
+    only.
+    """
     global vprops,_def,rwrules,sc_singletons
     global synclass
-    dct.serialize(mode)
+    if sp_index:
+        dct.serialize(mode,'spindex')
+    else:
+        dct.serialize(mode)
     if mode == 'w':
         serializer.encode_intlst(vprops,32) 
         serializer.encode_intlst(_def,32)
@@ -217,22 +676,196 @@ def serialize(mode):
     sc_dct.serialize(mode)
     rwrules.serialize(mode)
     prep_verb_fitness.serialize(mode)
+    if mode == 'r':
+        # per-entry attributes are held as arrays, whatever the
+        # source format.
+        compact()
+        overlay.n_base = dct.get_n()
+
+def serialize_inflections(mode):
+    """ read/write the inflection table """
+    global inflections
+    if mode == 'w':
+        inflections.serialize(mode)
+    else:
+        inflections = Inflections()
+        inflections.serialize(mode)
+
+def create_inflections():
+    """
+    Create the inflection table for the current vocabulary. We run
+    "is_word_variant" over every form that could be a variant of an
+    entry: the root plus each suffix it checks for ("wanting",
+    "hating", "wanted", "isn't", "softly", "strongest"...).
+    """
+    global inflections
+    forms = set()
+    for sp in dct.spelling:
+        if sp != sp.lower():
+            continue
+        stems = [sp]
+        if sp.endswith('e'):
+            stems.append(sp[:-1])
+        for stem in stems:
+            for sfx in ("ing","ed","est","er"):
+                forms.add(stem + sfx)
+        for sfx in ("n't","es","s","ly"):
+            forms.add(sp + sfx)
+    inflections = Inflections()
+    forms = list(forms)
+    forms.sort()
+    for form in forms:
+        # a form that's in the vocabulary isn't analysed
+        if dct.lkup(form,False) != 0:
+            continue
+        v = WordVariant()
+        if is_word_variant(form,v):
+            inflections.add(form,v)
+
+def create_sp_index():
+    """ create the spelling index for the vocabulary """
+    dct.index = SpellingIndex()
+    dct.index.build(dct.spelling)
+
+def serialize_sp_index(mode):
+    """
+    write the spelling index, if we have one. It's read by
+    "Dict.serialize".
+    """
+    if dct.index is not None:
+        serializer.begin_section('spindex')
+        dct.index.serialize(mode)
 
+def find_word_variant(wrd,v):
+    """
+    is an unknown word a variant of a known word? This uses the
+    inflection table if we have one, otherwise "is_word_variant".
+    A word is analysed against the base vocabulary only: it's never
+    a variant of another unknown word.
+    """
+    if inflections is None:
+        return is_word_variant(wrd,v)
+    return inflections.lkup(wrd,v)
 def lkup(sp,create_if_missing):
     """ lookup "sp", returning the key for its entry """
     global _def,synclass,rwrules
     ix = dct.lkup(sp,False)
     if ix != 0:
+        if ix >= overlay.n_base and overlay.max_n is not None:
+            overlay.last_used[ix] = overlay.n_parse
         return ix
     if not create_if_missing:
         return 0
-    ix = dct.lkup(sp,True)
-    vprops.append(0);
-    _def.append(0);
-    synclass.append(0)
-    rwrules.index.append(None)
+    if len(overlay.free) > 0:
+        # reuse an evicted entry
+        ix = overlay.free.pop()
+        dct.sp_to_ix[sp] = ix
+        dct.spelling[ix] = sp
+    else:
+        ix = dct.lkup(sp,True)
+        vprops.append(0);
+        _def.append(0);
+        synclass.append(0)
+        rwrules.index.append(None)
+    if ix >= overlay.n_base:
+        overlay.n_added += 1
+        if overlay.max_n is not None:
+            overlay.last_used[ix] = overlay.n_parse
+    if sp in expansions.watch:
+        expansions.drop(expansions.watch.pop(sp))
     return ix
 
+def get_overlay_n():
+    """ get number of entries in the overlay """
+    return dct.get_n() - overlay.n_base - len(overlay.free)
+
+def get_overlay_stats():
+    """ get metrics for the overlay: a dict """
+    return {'n_base':overlay.n_base,
+        'n':get_overlay_n(),
+        'max_n':overlay.max_n,
+        'added':overlay.n_added,
+        'evicted':overlay.n_evicted,
+        'resets':overlay.n_reset}
+
+def get_expansion_stats():
+    """ get metrics for the lexer's expansion cache: a dict """
+    n_lkup = expansions.n_hit + expansions.n_miss
+    return {'n':len(expansions.map),
+        'max_n':expansions.max_n,
+        'hits':expansions.n_hit,
+        'misses':expansions.n_miss,
+        'hit_rate':float(expansions.n_hit)/n_lkup if n_lkup else 0.0,
+        'clears':expansions.n_clear}
+
+def set_overlay_max(max_n):
+    """
+    Set the bound on the overlay. None means the overlay is dropped
+    at the start of each parse; otherwise it's shared by parses, and
+    kept to "max_n" entries.
+    """
+    reset_overlay()
+    overlay.max_n = max_n
+
+def reset_overlay():
+    """ drop all overlay entries """
+    n_base = overlay.n_base
+    if dct.get_n() == n_base:
+        return
+    overlay.n_evicted += get_overlay_n()
+    overlay.n_reset += 1
+    for sp in dct.spelling[n_base:]:
+        if sp in dct.sp_to_ix:
+            del dct.sp_to_ix[sp]
+    del dct.spelling[n_base:]
+    del dct.props[n_base:]
+    del vprops[n_base:]
+    del _def[n_base:]
+    del synclass[n_base:]
+    del rwrules.index[n_base:]
+    overlay.last_used = {}
+    overlay.free = []
+    expansions.drop_overlay()
+
+def evict_overlay(n):
+    """
+    Evict the "n" least recently used overlay entries (LRU mode).
+    Entries defined in terms of an evicted entry ("Foo" is defined
+    as "foo") are evicted too.
+    """
+    last_used = overlay.last_used
+    victims = set(sorted(last_used,key=last_used.get)[:n])
+    while True:
+        more = [ix for ix in last_used \
+            if ix not in victims and _def[ix] in victims]
+        if len(more) == 0:
+            break
+        victims.update(more)
+    for ix in victims:
+        del dct.sp_to_ix[dct.spelling[ix]]
+        dct.spelling[ix] = ''
+        dct.props[ix] = 0
+        vprops[ix] = 0
+        _def[ix] = 0
+        synclass[ix] = 0
+        rwrules.index[ix] = None
+        del last_used[ix]
+        overlay.free.append(ix)
+    overlay.n_evicted += len(victims)
+    expansions.drop_overlay()
+
+def begin_parse():
+    """
+    Called at the start of each parse (and, when parsing a file in
+    sections, after each section is handed to the delegate): drop the
+    overlay, or trim it to its bound.
+    """
+    overlay.n_parse += 1
+    if overlay.max_n is None:
+        reset_overlay()
+    elif get_overlay_n() > overlay.max_n:
+        evict_overlay(get_overlay_n() - overlay.max_n)
+
 def define(sp,_props,vprops,_def):
     """ define an entry """
     ix = lkup(sp,True)
@@ -301,10 +934,31 @@ def check_prop(ix,v):
     """ check prop """
     return dct.check_prop(ix,v)
 
+def get_entry_attrs(toks,S=0,E=None):
+    """
+    get the attributes for the tokens toks[S..E] (default is all of
+    them). Returns a tuple of lists: (vprops,def,synclass), with one
+    element per token. Note "vprops" and "synclass" are the raw
+    vocabulary values.
+    """
+    if E is None:
+        E = len(toks)-1
+    rng = xrange(S,E+1)
+    return ([vprops[toks[i]] for i in rng],
+        [_def[toks[i]] for i in rng],
+        [synclass[toks[i]] for i in rng])
+
 def get_prep_verb_fitness(prep,verb):
     """ get strength of association between prep and verb """
     return prep_verb_fitness.lkup(prep,verb)
 
+def get_prep_verb_fitness_lst(prep,verbs):
+    """
+    get strength of association between prep and each verb in
+    "verbs": returns a list.
+    """
+    return prep_verb_fitness.lkup_lst(prep,verbs)
+
 def is_verb_variant(wrd,v):
     """
     is an unknown word a variant of a known verb? We expect the
@@ -536,7 +1190,7 @@ def get_vocab(sp):
             return ix
     # is this word a variant of a known word?
     wv = WordVariant()
-    if is_word_variant(sp_lc,wv):
+    if find_word_variant(sp_lc,wv):
         set_def(ix,wv.root_key)
         set_prop(ix,wv.props)
         set_vp(ix,wv.vprops)
@@ -588,12 +1242,24 @@ def test_rewrite(rix,toks,i):
 
 def find_rewrite(toks,i):
     """ find rewrite rule that applies to toks[i] """
-    rules = rwrules.index[get_def(toks[i])]
-    if rules != None:
-        for rix in rules:
-            if test_rewrite(rix,toks,i):
-                return rix
-    return None
+    if rwrules.trie is None:
+        rwrules.compile()
+    node = rwrules.trie[0].get(get_def(toks[i]))
+    if node is None:
+        return None
+    rix = node[2]
+    pos = node[1]
+    n = len(toks)
+    i += 1
+    while i < n:
+        node = node[0].get(get_def(toks[i]))
+        if node is None:
+            break
+        if node[2] is not None and (pos is None or node[1] < pos):
+            pos = node[1]
+            rix = node[2]
+        i += 1
+    return rix
 
 def get_rhs_rewrite(rix,want_upper):
     """ get rhs tokens for rewrite rule """
@@ -624,15 +1290,14 @@ def print_rewrite_rules():
                 (i,spell(i),myrules) 
 
 
-def print_prep_verb_fitness(self):
+def print_prep_verb_fitness():
     """ print (prep,verb)->fitness mapping. """
     print "Preps-for-verbs:"
     tmp = []
-    for key,cnt in self.prep_verb_fitness.pair_to_v.iteritems():
-        _pix,_vix = key.split(" ")
-        sp_prep = spell(int(pix))
-        sp_verb = spell(int(vix))
-        tmp.append('%s,%s : %d', sp_prep,sp_verb,cnt)
+    for key,cnt in prep_verb_fitness.pair_to_v.iteritems():
+        sp_prep = spell(key>>16)
+        sp_verb = spell(key & 0xffff)
+        tmp.append('%s,%s : %d' % (sp_prep,sp_verb,cnt))
     tmp.sort()
     for e in tmp:
         print e
@@ -665,9 +1330,8 @@ def print_wrd_info(sp):
         for rix in rwrules.index[i]:
             print_rewrite_rule(rix)
     for key,cnt in prep_verb_fitness.pair_to_v.iteritems():        
-        _pix,_vix = key.split(" ")
-        pix = int(_pix)
-        vix = int(_vix)
+        pix = key>>16
+        vix = key & 0xffff
         sp_prep = spell(pix)
         sp_verb = spell(vix)
         if i == pix or i == vix:
@@ -24,10 +24,17 @@ class Xfrm():
     parse graph. Each transform is implented as a class, whose
     "doXfrm" method roes the work. Some transforms are purely
     programmatic, while others ure data tables: these implement
-    "serialize".
+    "serialize", and set "tables" True.
     """
+    # does this transform have tables (serialized data)?
+    tables = False
+
     def __init__(self,_name):
         self.name = _name
+        # deferred read: if defined, this is the name of the
+        # serialization file containing our tables. See
+        # "defer_serialize".
+        self.deferred = None
 
     def do_xfrm(self):
         pass
@@ -35,5 +42,41 @@ class Xfrm():
     def serialize(self,mode):
         pass
 
+    def compact(self):
+        """
+        Convert our tables to compact, read-only friendly forms (see
+        "parser.compact_tables").
+        """
+        pass
+
+    def defer_serialize(self):
+        """
+        Called in place of "serialize('r')", when the serialization
+        file has a section for this transform: we record the file,
+        and read the section on first use (see "load").
+        """
+        self.deferred = serializer.fn
+
+    def load(self):
+        """
+        Complete a deferred read. This is a no-op if our tables have
+        been read. If the read fails, the exception is passed on and
+        the read stays deferred: it's tried again on next use.
+        """
+        if self.deferred is None:
+            return
+        # we may be called in the middle of some other serialization
+        state = serializer.get_state()
+        try:
+            serializer.init(self.deferred,'r')
+            try:
+                serializer.begin_section(self.name)
+                self.serialize('r')
+            finally:
+                serializer.fini()
+        finally:
+            serializer.set_state(state)
+        self.deferred = None
+
     def printme(self,fp):
         fp.write('Xfrm %s\n' % self.name)